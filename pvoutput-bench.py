@@ -0,0 +1,544 @@
+import argparse
+import BaseHTTPServer
+import datetime
+import hashlib
+import imp
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import urlparse
+
+POSTER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'pvoutput-poster.py',
+)
+
+SPANS = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+    'year': 365,
+}
+
+
+def _span(value):
+    # A named span, or a number of days
+    if value in SPANS:
+        return SPANS[value]
+    try:
+        days = float(value)
+    except ValueError:
+        days = 0
+    if days <= 0:
+        raise argparse.ArgumentTypeError(
+            "expected %s or a number of days" % ", ".join(sorted(SPANS))
+        )
+    return days
+
+
+# Statements executed through any sqlite3 connection (the poster's, its
+# upload worker's and the recompute workers' alike); phases are measured
+# by the difference across them. Connection.execute() goes through
+# cursor(), so overriding that catches both.
+_queries = [0]
+
+
+class CountingCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        _queries[0] += 1
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        _queries[0] += 1
+        return sqlite3.Cursor.executemany(self, *args)
+
+
+class CountingConnection(sqlite3.Connection):
+
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+_connect = sqlite3.connect
+
+
+def _counting_connect(*args, **kwargs):
+    kwargs.setdefault('factory', CountingConnection)
+    return _connect(*args, **kwargs)
+
+
+class StubPVOutput(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Just enough of PVOutput for the poster: addstatus.jsp and
+    # addbatchstatus.jsp over keep-alive connections, the hourly rate limit
+    # (reported in the X-Rate-Limit-* headers when asked for) and a
+    # "d,t,1" reply for each status in a batch
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response, and send it in one go when it's complete
+    # (headers and body sent separately stall on delayed ACKs)
+    wbufsize = -1
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.getheader('content-length', 0))
+        params = urlparse.parse_qs(self.rfile.read(length))
+        with server.requests.get_lock():
+            server.requests.value += 1
+        if server.LATENCY:
+            time.sleep(server.LATENCY)
+
+        now = time.time()
+        if now >= server.rate_reset:
+            server.rate_remaining = server.RATE_LIMIT
+            server.rate_reset = int(now - (now % 3600) + 3600)
+        if server.rate_remaining <= 0:
+            self._reply(403, "Forbidden 403: Exceeded %d requests per hour" % (
+                server.RATE_LIMIT,
+            ))
+            return
+        server.rate_remaining -= 1
+
+        if self.path == server.ADDBATCHSTATUS:
+            statuses = params.get('data', [''])[0].split(';')
+            if len(statuses) > server.BATCH_LIMIT:
+                self._reply(400, "Bad request 400: Maximum %d statuses" % (
+                    server.BATCH_LIMIT,
+                ))
+                return
+            added = []
+            for status in statuses:
+                fields = status.split(',')
+                if len(fields) < 2:
+                    continue
+                added.append("%s,%s,1" % (fields[0], fields[1]))
+            self._reply(200, ';'.join(added))
+        elif self.path == server.ADDSTATUS:
+            self._reply(200, "OK 200: Added Status")
+        else:
+            self._reply(404, "Not Found")
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        if self.headers.getheader('x-rate-limit') == '1':
+            self.send_header('X-Rate-Limit-Remaining', str(self.server.rate_remaining))
+            self.send_header('X-Rate-Limit-Limit', str(self.server.RATE_LIMIT))
+            self.send_header('X-Rate-Limit-Reset', str(self.server.rate_reset))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PVOutputBench():
+
+    def __init__(self, args):
+        self.DAYS = args.span
+        self.PANELS = args.panels
+        self.SEED = args.seed
+        self.DATA_DIR = args.keep
+        self.INDEX = not args.no_index
+        self.VERBOSE = args.verbose
+
+        # The stub PVOutput's rate limit (API calls per hour), largest
+        # batch and per-request latency (in seconds)
+        self.RATE_LIMIT = args.rate_limit
+        self.BATCH_LIMIT = 100
+        self.LATENCY = args.latency / 1000.0
+
+        # The synthetic system: rated output per panel (W), the household
+        # load that's always there (W), and how often the collectors take
+        # readings (s)
+        self.PANEL_W = 250
+        self.LOAD_W = 250
+        self.READING_INTERVAL = 60
+        self.DEMAND_INTERVAL = 15
+
+        self.stub = None
+        self.history = None
+        self.phases = {}
+        self.rows = {}
+
+    def _start_stub(self):
+        # The stub runs in a child process, so serving requests doesn't
+        # contend with the upload worker for the GIL
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubPVOutput)
+        server.ADDSTATUS = "/service/r2/addstatus.jsp"
+        server.ADDBATCHSTATUS = "/service/r2/addbatchstatus.jsp"
+        server.RATE_LIMIT = self.RATE_LIMIT
+        server.BATCH_LIMIT = self.BATCH_LIMIT
+        server.LATENCY = self.LATENCY
+        server.rate_remaining = self.RATE_LIMIT
+        server.rate_reset = 0
+        server.requests = multiprocessing.Value('i', 0)
+        process = multiprocessing.Process(target=server.serve_forever)
+        process.daemon = True
+        process.start()
+        server.socket.close()
+        self.stub = (server, process)
+        os.environ['PVO_HOST'] = '127.0.0.1:%d' % server.server_port
+
+    def _stop_stub(self):
+        if self.stub is not None:
+            self.stub[1].terminate()
+            self.stub[1].join()
+
+    def _generate(self, poster, t_start, t_end):
+        # Readings from a little before the first slot to a little after
+        # the last, from a simple model of the system: a sine curve of
+        # generation between sunrise and sunset (a quarter of an hour in
+        # from each, so there's never generation the poster would reject),
+        # scaled by each day's cloud cover, against a household load with
+        # an evening peak and the odd appliance switching on
+        rand = random.Random(self.SEED)
+        t_first = t_start - 2 * poster.INTERVAL
+        t_last = t_end + poster.INTERVAL
+
+        meter = sqlite3.connect(poster.METER_DB)
+        meter.execute('''
+            CREATE TABLE metered (
+                timestamp INTEGER, Wh_in REAL, Wh_out REAL
+            )
+        ''')
+        meter.execute('''
+            CREATE TABLE demand (
+                timestamp INTEGER, watts INTEGER
+            )
+        ''')
+        solar = sqlite3.connect(poster.SOLAR_DB)
+        solar.execute('''
+            CREATE TABLE system (
+                timestamp INTEGER, pac_W INTEGER, etot_Wh INTEGER
+            )
+        ''')
+        solar.execute('''
+            CREATE TABLE panels (
+                timestamp INTEGER, macrf TEXT,
+                Tdsp_degC REAL, Tmos_degC REAL, Vin_V REAL
+            )
+        ''')
+
+        panels = ['%06x' % (0x4a3f00 + i) for i in xrange(self.PANELS)]
+        days = {}
+        Wh_in = 4000000.0
+        Wh_out = 1500000.0
+        etot_Wh = 9000000.0
+        appliance_W = 0
+        appliance_until = 0
+        metered = []
+        demand = []
+        system = []
+        panel_rows = []
+        obs = []
+
+        t = t_first
+        while t <= t_last:
+            local = time.localtime(t)
+            day = (local.tm_year, local.tm_mon, local.tm_mday)
+            if day not in days:
+                (sr, ss) = poster._compute_sun_times(datetime.date(*day))
+                days[day] = (sr + 900, ss - 900, rand.uniform(0.3, 1.0), rand.uniform(8, 24))
+            (up, down, sky, mean_degC) = days[day]
+            hour = local.tm_hour + local.tm_min / 60.0
+            degC = mean_degC + 6 * math.sin(2 * math.pi * (hour - 9) / 24)
+
+            pac_W = 0.0
+            if up < t < down:
+                pac_W = (self.PANELS * self.PANEL_W * sky *
+                         math.sin(math.pi * (t - up) / (down - up)) *
+                         rand.uniform(0.85, 1.0))
+
+            if t >= appliance_until:
+                appliance_W = 0
+                if rand.random() < 0.02:
+                    appliance_W = rand.choice([1000, 2000, 2400])
+                    appliance_until = t + rand.randint(3, 20) * 60
+            load_W = self.LOAD_W + appliance_W + rand.uniform(0, 100)
+            if 17 <= local.tm_hour < 22:
+                load_W += 600
+
+            # The meter counts in 100Wh increments, the inverters in 1Wh
+            for i in xrange(0, self.READING_INTERVAL, self.DEMAND_INTERVAL):
+                net_W = load_W - pac_W + rand.uniform(-30, 30)
+                demand.append((t + i, int(net_W)))
+                if net_W > 0:
+                    Wh_in += net_W * self.DEMAND_INTERVAL / 3600.0
+                else:
+                    Wh_out -= net_W * self.DEMAND_INTERVAL / 3600.0
+            metered.append((t, Wh_in - Wh_in % 100, Wh_out - Wh_out % 100))
+            etot_Wh += pac_W * self.READING_INTERVAL / 3600.0
+            system.append((t, int(pac_W), int(etot_Wh)))
+            if t == t_start - poster.INTERVAL:
+                # The row a previous run would have left for the slot
+                # before the span: (timestamp, v1, v3)
+                self.history = (
+                    t,
+                    int(etot_Wh),
+                    int(etot_Wh + metered[-1][1] - metered[-1][2]),
+                )
+            if pac_W > 0:
+                for macrf in panels:
+                    panel_W = pac_W / self.PANELS
+                    panel_rows.append((
+                        t,
+                        macrf,
+                        round(degC + 15 + panel_W / 20 + rand.uniform(-2, 2), 1),
+                        round(degC + 20 + panel_W / 15 + rand.uniform(-2, 2), 1),
+                        round(30 + panel_W / 50 + rand.uniform(-1, 1), 1),
+                    ))
+
+            # Half-hourly BOM observations
+            if t % 1800 == 0:
+                obs.append({
+                    'aifstime_utc': time.strftime("%Y%m%d%H%M%S", time.gmtime(t)),
+                    'air_temp': round(degC + rand.uniform(-0.5, 0.5), 1),
+                })
+
+            t += self.READING_INTERVAL
+
+        meter.executemany('''INSERT INTO metered VALUES (?, ?, ?)''', metered)
+        meter.executemany('''INSERT INTO demand VALUES (?, ?)''', demand)
+        meter.commit()
+        meter.close()
+        solar.executemany('''INSERT INTO system VALUES (?, ?, ?)''', system)
+        solar.executemany('''INSERT INTO panels VALUES (?, ?, ?, ?, ?)''', panel_rows)
+        solar.commit()
+        solar.close()
+
+        # BOM lists the newest observation first
+        obs.reverse()
+        with open(poster.WEATHER_JSON, 'wb') as fh:
+            json.dump({'observations': {'data': obs}}, fh)
+
+        self.rows = {
+            'metered': len(metered),
+            'demand': len(demand),
+            'system': len(system),
+            'panels': len(panel_rows),
+            'observations': len(obs),
+        }
+
+    def _phase(self, name, slots, function, *args):
+        # Time one phase, and count the statements it ran; peak RSS is
+        # the process's high-water mark at the end of it (in KB)
+        queries = _queries[0]
+        start = time.time()
+        function(*args)
+        wall = time.time() - start
+        queries = _queries[0] - queries
+
+        result = {
+            'wall_s': round(wall, 4),
+            'slots': slots,
+            'slots_per_s': None,
+            'queries': queries,
+            'queries_per_slot': None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        if wall > 0:
+            result['slots_per_s'] = round(slots / wall, 1)
+        if slots > 0:
+            result['queries_per_slot'] = round(queries / float(slots), 2)
+        self.phases[name] = result
+        return result
+
+    def _count(self, poster, query):
+        poster.cursor.execute(query)
+        return poster.cursor.fetchall()[0][0]
+
+    def _compute(self, poster, t_start, t_end):
+        # Uploads are held back until the upload phase, rather than going
+        # up from the worker thread while slots are still being computed
+        poster._queue_upload = lambda item=None: None
+        try:
+            poster._compute(t_start, t_end)
+        finally:
+            del poster._queue_upload
+
+    def _fill_in(self, poster, t_start, t_end):
+        poster._fill_in_temperatures(t_start, t_end)
+        poster.pvo_db.commit()
+
+    def _upload(self, poster):
+        poster._queue_upload()
+        poster._finish_uploads()
+
+    def run(self):
+        data_dir = self.DATA_DIR
+        if data_dir is None:
+            data_dir = tempfile.mkdtemp(prefix='pvoutput-bench.')
+        elif not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        for name in ('raven.sqlite', 'solar.sqlite', 'pvoutput.sqlite', 'weather.json'):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(os.path.join(data_dir, name + suffix)):
+                    os.remove(os.path.join(data_dir, name + suffix))
+        os.environ['DATA_DIR'] = data_dir
+        os.environ.setdefault('API_KEY', 'bench')
+        os.environ.setdefault('SYSTEM_ID', '1')
+
+        with open(POSTER, 'rb') as fh:
+            version = hashlib.sha1(fh.read()).hexdigest()
+
+        stdout = sys.stdout
+        self._start_stub()
+        try:
+            if not self.VERBOSE:
+                sys.stdout = open(os.devnull, 'w')
+            started = time.time()
+            module = imp.load_source('pvoutput_poster', POSTER)
+            sqlite3.connect = _counting_connect
+            poster = module.PVOutputPoster()
+
+            # A span of whole slots, ending an hour ago
+            now = int(time.time())
+            t_end = now - (now % poster.INTERVAL) - 3600
+            t_start = t_end - int(self.DAYS * 86400)
+            t_start -= t_start % poster.INTERVAL
+            slots = len(list(poster._slots(t_start, t_end)))
+
+            start = time.time()
+            self._generate(poster, t_start, t_end)
+            if self.INDEX:
+                poster._index_source_dbs()
+            poster.cursor.execute('''
+                INSERT INTO pvoutput (timestamp, v1, v3, need_upload)
+                    VALUES (?, ?, ?, 0)
+                ''', self.history)
+            poster.pvo_db.commit()
+            generate = time.time() - start
+
+            # Observations first, as they'd usually be there already; the
+            # fill-in phase then has every row's temperature to find
+            # again, as after the weather feed has been down for the span
+            self._phase('ingest', slots, poster._ingest_temperatures)
+            self.phases['ingest']['observations'] = self.rows['observations']
+
+            self._phase('compute', slots, self._compute, poster, t_start, t_end)
+            self.phases['compute']['rows'] = self._count(poster, '''
+                SELECT COUNT(*) FROM pvoutput
+            ''') - 1
+
+            poster.cursor.execute('''UPDATE pvoutput SET v5 = NULL''')
+            poster.pvo_db.commit()
+            self._phase('fill_in', slots, self._fill_in, poster, t_start, t_end)
+            self.phases['fill_in']['rows'] = self._count(poster, '''
+                SELECT COUNT(*) FROM pvoutput WHERE v5 IS NOT NULL
+            ''')
+
+            requests = self.stub[0].requests.value
+            self._phase('upload', slots, self._upload, poster)
+            self.phases['upload']['rows'] = self._count(poster, '''
+                SELECT COUNT(*) FROM pvoutput WHERE need_upload = 0
+            ''') - 1
+            self.phases['upload']['api_calls'] = self.stub[0].requests.value - requests
+
+            poster.close()
+            total = time.time() - started
+        finally:
+            sqlite3.connect = _connect
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+            self._stop_stub()
+            if self.DATA_DIR is None:
+                shutil.rmtree(data_dir)
+
+        return {
+            'version': version[:12],
+            'started': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(started)),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'span_days': self.DAYS,
+            'panels': self.PANELS,
+            'seed': self.SEED,
+            'indexed': self.INDEX,
+            'slots': slots,
+            'rows': self.rows,
+            'generate_s': round(generate, 4),
+            'phases': self.phases,
+            'total': {
+                'wall_s': round(total, 4),
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the PVOutput poster on synthetic data",
+    )
+    parser.add_argument(
+        "--span",
+        type=_span,
+        default=SPANS['day'],
+        metavar="SPAN",
+        help="how much history to generate and post: day (the default), "
+             "week, month, year, or a number of days",
+    )
+    parser.add_argument(
+        "--panels",
+        type=int,
+        default=12,
+        help="number of panels (micro-inverters) reporting",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="seed for the synthetic data",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="leave the source databases unindexed, as before migrate",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=100000,
+        help="API calls per hour the stub PVOutput allows",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        metavar="MS",
+        help="time the stub PVOutput takes over each request",
+    )
+    parser.add_argument(
+        "--keep",
+        metavar="DIR",
+        help="generate the data in (and leave it in) DIR, rather than a "
+             "temporary directory",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="append the results to FILE as a line of JSON, rather than "
+             "printing them",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="show the poster's output",
+    )
+    args = parser.parse_args()
+
+    results = PVOutputBench(args).run()
+    if args.output is None:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        with open(args.output, 'a') as fh:
+            fh.write(json.dumps(results, sort_keys=True) + "\n")
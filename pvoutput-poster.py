@@ -1,60 +1,892 @@
+import time
+
+# Startup is timed from here (see --profile-startup)
+_started = time.time()
+
 import argparse
+import bisect
 import calendar
-import httplib
-import json
+import collections
+import datetime
+import errno
+import importlib
 import os
+import Queue
+import select
+import signal
 import sqlite3
+import struct
 import sys
-import time
 import threading
-import urllib
-import astral
-import datetime
+
+# Modules only some runs need (astral, which brings in pytz, for new days'
+# sun times; httplib, urllib and socket, which bring in ssl, for uploads;
+# json and hashlib for a new weather.json, and json or csv for export;
+# multiprocessing for recompute; ctypes for --watch) are imported when first used, through
+# _lazy_import(), which keeps a note of how long each took
+_import_times = collections.OrderedDict([
+    ('(at startup)', time.time() - _started),
+])
+
+
+def _lazy_import(name):
+    if name not in sys.modules:
+        start = time.time()
+        importlib.import_module(name)
+        _import_times[name] = time.time() - start
+    else:
+        # Another thread (see PVOutputSystems) may be part way through
+        # importing it: this waits on the import lock for that to finish,
+        # rather than handing back a module that's only half there
+        importlib.import_module(name)
+    return sys.modules[name]
+
+
+def _profile_startup():
+    print "Startup profile:"
+    for (name, seconds) in _import_times.items():
+        print "    import %-16s %7.1fms" % (name, seconds * 1000)
+    print "    %-23s %7.1fms" % ("whole run", (time.time() - _started) * 1000)
+
+# time.monotonic() is Python 3 only; os.times()[4] (elapsed real time since
+# an arbitrary point) is the nearest Python 2 equivalent
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    _monotonic = lambda: os.times()[4]
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _in_process_time_zone(name):
+    # Whether the named time zone keeps to the same UTC offset as the
+    # process's (TZ) every day for the coming year
+    pytz = _lazy_import('pytz')
+    zone = pytz.timezone(name)
+    now = int(time.time())
+    for t in xrange(now, now + 366 * 86400, 86400):
+        offset = datetime.datetime.fromtimestamp(t, zone).utcoffset()
+        if calendar.timegm(time.localtime(t)) - t != offset.days * 86400 + offset.seconds:
+            return False
+    return True
+
+
+def _load_config(path):
+    # The systems to serve from a --config file: a JSON object with a
+    # "systems" list and, optionally, how many "workers" to run them on.
+    # Each system needs a unique "name", its "system_id" and a "data_dir";
+    # "api_key", "host", "meter_db", "solar_db", "pvoutput_db",
+    # "weather_json", "location", "tariff", "baseload" and "batch_size"
+    # are optional (see PVOutputPoster.__init__). Times are posted, and
+    # days and tariff hours worked out, in the process's time zone, so a
+    # location has to be in that one too.
+    json = _lazy_import('json')
+    with open(path) as f:
+        config = json.load(f)
+    systems = config.get('systems', [])
+    if systems == []:
+        raise ValueError("%s: no systems" % path)
+    names = set()
+    for system in systems:
+        for key in ('name', 'system_id', 'data_dir'):
+            if key not in system:
+                raise ValueError("%s: system %s has no %s" % (
+                    path, system.get('name', len(names) + 1), key))
+        if system['name'] in names:
+            raise ValueError("%s: system %s is listed twice" % (path, system['name']))
+        if 'api_key' not in system and 'API_KEY' not in os.environ:
+            raise ValueError("%s: system %s has no api_key (and API_KEY isn't set)" % (
+                path, system['name']))
+        location = system.get('location')
+        if location is not None:
+            if len(location) != 6:
+                raise ValueError("%s: system %s's location isn't [name, region, latitude, longitude, time zone, elevation]" % (
+                    path, system['name']))
+            try:
+                same_zone = _in_process_time_zone(location[4])
+            except KeyError:
+                # pytz.UnknownTimeZoneError
+                raise ValueError("%s: system %s has an unknown time zone %s" % (
+                    path, system['name'], location[4]))
+            if not same_zone:
+                raise ValueError("%s: system %s is in %s, which isn't the process's time zone (TZ)" % (
+                    path, system['name'], location[4]))
+        names.add(system['name'])
+    return config
+
+
+def _recompute_init(poster):
+    # Runs in each recompute worker: a fork of the poster, which reopens
+    # the databases read-only rather than using the parent's connections
+    global _recompute_poster
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    poster.source_dbs = {}
+    poster.pvo_db = poster._connect_read_only(poster.PVO_DB)
+    poster.pvo_db.row_factory = sqlite3.Row
+    poster.cursor = poster.pvo_db.cursor()
+    poster.verbose = False
+    _recompute_poster = poster
+
+
+def _recompute_partition(partition):
+    # (exit code, rows, slot_series rows) for one partition; the poster
+    # exits on data it can't make sense of, which mustn't take the worker
+    # down with it
+    try:
+        entries = _recompute_poster._compute_partition(*partition)
+    except SystemExit as e:
+        return (e.code, None, None)
+    return (0, entries, _recompute_poster._take_slot_series())
+
+
+class _CountingCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        self.connection.on_query()
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        self.connection.on_query()
+        return sqlite3.Cursor.executemany(self, *args)
+
+
+class _CountingConnection(sqlite3.Connection):
+    # Calls on_query() for each statement run on it, where sqlite3 has no
+    # set_trace_callback() (Python 2); Connection.execute() goes through
+    # cursor() too
+
+    def cursor(self, factory=_CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+# Every statement the poster runs is defined once, here, and registered
+# with the table it's run against; migrate shows how each is planned
+_queries = collections.OrderedDict()
+
+
+def _query(table, sql):
+    _queries[sql] = table
+    return sql
+
+
+def _window(table):
+    # WHERE clause for the rows of table from the last one before the
+    # first ? to the first one at or after the third (the second and
+    # fourth are used where there's no such row)
+    return '''
+        WHERE timestamp >= COALESCE((
+            SELECT MAX(timestamp) FROM %(table)s WHERE timestamp < ?), ?)
+        AND timestamp <= COALESCE((
+            SELECT MIN(timestamp) FROM %(table)s WHERE timestamp >= ?), ?)
+    ''' % {'table': table}
+
+# The collectors' databases
+_SOURCE_TABLES = ('metered', 'demand', 'system', 'panels')
+_METERED_WINDOW = _query('metered', '''
+    SELECT * FROM metered %s
+        ORDER BY timestamp ASC
+    ''' % _window('metered'))
+_METERED_BEFORE = _query('metered', '''
+    SELECT * FROM metered
+        WHERE timestamp < ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ''')
+_METERED_AFTER = _query('metered', '''
+    SELECT * FROM metered
+        WHERE timestamp >= ?
+        ORDER BY timestamp ASC
+        LIMIT 1
+    ''')
+_LAST_METERED = _query('metered', '''SELECT MAX(timestamp) FROM metered''')
+_DEMAND_EXPORT = _query('demand', '''
+    SELECT avg(watts) FROM demand
+        WHERE (timestamp > ?) AND (timestamp <= ?) AND (watts < 0)
+    ''')
+_SYSTEM_WINDOW = _query('system', '''
+    SELECT * FROM system %s
+        ORDER BY timestamp ASC
+    ''' % _window('system'))
+_SYSTEM_START = _query('system', '''
+    SELECT COALESCE((
+        SELECT MAX(timestamp) FROM system WHERE timestamp < ?), ?)
+    ''')
+_PEAK_SINCE = _query('system', '''
+    SELECT MAX(etot_Wh) FROM system
+        WHERE timestamp >= ? AND timestamp < ?
+    ''')
+_PEAK_BEFORE = _query('system', '''
+    SELECT MAX(etot_Wh) FROM system
+        WHERE timestamp < ?
+    ''')
+_SYSTEM_BEFORE = _query('system', '''
+    SELECT * FROM system
+        WHERE timestamp < ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ''')
+_SYSTEM_AFTER = _query('system', '''
+    SELECT * FROM system
+        WHERE timestamp >= ?
+        ORDER BY timestamp ASC
+        LIMIT 1
+    ''')
+_LAST_SYSTEM = _query('system', '''SELECT MAX(timestamp) FROM system''')
+_PANELS_WINDOW = _query('panels', '''
+    SELECT macrf, avg(Tdsp_degC), avg(Tmos_degC), avg(Vin_V) FROM panels
+        WHERE (timestamp >= ?) AND (timestamp <= ?)
+        GROUP BY macrf
+    ''')
+_PANELS_BATCH = _query('panels', '''
+    SELECT timestamp - (timestamp % ?) + o AS slot, macrf,
+           avg(Tdsp_degC), avg(Tmos_degC), avg(Vin_V)
+        FROM panels CROSS JOIN (SELECT 0 AS o UNION ALL SELECT ? AS o)
+        WHERE (timestamp >= ?) AND (timestamp <= ?)
+        AND ((o = 0 AND timestamp % ? <= ?) OR
+             (o > 0 AND timestamp % ? >= ?))
+        GROUP BY slot, macrf
+        ORDER BY slot ASC
+    ''')
+
+# Fingerprinting the source rows (see _source_buckets): for metered and
+# system, the span from the last reading before the first ? to the first
+# at or after the third; and for each table, per-bucket sums (COUNT,
+# highest rowid and TOTALs weighted by time of day, so values moved
+# between rows count, in one string) and for system the largest etot_Wh,
+# either walking the buckets in order, each summed up straight from the
+# index, or in one GROUP BY (where there's no index to walk)
+_SOURCE_SPAN = {}
+_BUCKETS_WALKED = {}
+_BUCKETS_GROUPED = {}
+for (table, columns) in (('metered', ('Wh_in', 'Wh_out')),
+                         ('demand', ('watts',)),
+                         ('system', ('etot_Wh',)),
+                         ('panels', ('Tdsp_degC', 'Tmos_degC', 'Vin_V'))):
+    if table in ('metered', 'system'):
+        _SOURCE_SPAN[table] = _query(table, '''
+            SELECT
+                COALESCE((SELECT MAX(timestamp) FROM %(table)s WHERE timestamp < ?), ?),
+                COALESCE((SELECT MIN(timestamp) FROM %(table)s WHERE timestamp >= ?), ?)
+            ''' % {'table': table})
+    sums = " || ',' || ".join(
+        ['COUNT(*)', 'MAX(rowid)', 'TOTAL(timestamp)'] +
+        ['TOTAL(%s * (timestamp %% 86400 + 1))' % column for column in columns]
+    )
+    (maximum, bucket_maximum) = ('NULL', 'NULL')
+    if table == 'system':
+        maximum = 'MAX(etot_Wh)'
+        bucket_maximum = '''(
+                SELECT MAX(etot_Wh) FROM system
+                    WHERE timestamp >= start AND timestamp < slot
+            )'''
+    _BUCKETS_WALKED[table] = _query(table, '''
+        WITH RECURSIVE bucket (start, slot) AS (
+            SELECT ?, ?
+            UNION ALL
+            SELECT slot, MIN(slot - slot %% 3600 + (slot %% 3600 / ? + 1) * ?,
+                             slot - slot %% 3600 + 3600)
+                FROM bucket
+                WHERE slot < ?
+        )
+        SELECT slot, (
+            SELECT %s FROM %s
+                WHERE timestamp >= start AND timestamp < slot
+        ), %s FROM bucket
+        ''' % (sums, table, bucket_maximum))
+    _BUCKETS_GROUPED[table] = _query(table, '''
+        SELECT MIN(timestamp - timestamp %% 3600 + (timestamp %% 3600 / ? + 1) * ?,
+                   timestamp - timestamp %% 3600 + 3600) AS slot,
+               %s, %s
+            FROM %s
+            WHERE timestamp >= ? AND timestamp < ?
+            GROUP BY slot
+            ORDER BY slot ASC
+        ''' % (sums, maximum, table))
+
+# What _sync_slot_series asks of each source table: its highest rowid,
+# the earliest of the rows past the last one seen and, for metered and
+# system, the last reading before that
+_MAX_ROWID = {}
+_FIRST_NEW_ROW = {}
+_LAST_BEFORE = {}
+for table in _SOURCE_TABLES:
+    _MAX_ROWID[table] = _query(table, '''SELECT MAX(rowid) FROM %s''' % table)
+    _FIRST_NEW_ROW[table] = _query(table, '''
+        SELECT MIN(+timestamp) FROM %s
+            WHERE rowid > ?
+        ''' % table)
+    if table in ('metered', 'system'):
+        _LAST_BEFORE[table] = _query(table, '''
+            SELECT MAX(timestamp) FROM %s
+                WHERE timestamp < ?
+            ''' % table)
+
+# pvoutput.sqlite
+_LAST_ENTRY = _query('pvoutput', '''SELECT timestamp FROM pvoutput ORDER BY timestamp DESC LIMIT 1''')
+_FIRST_ENTRY = _query('pvoutput', '''SELECT MIN(timestamp) FROM pvoutput''')
+_ROW_BEFORE = _query('pvoutput', '''
+    SELECT timestamp, v1, v3 FROM pvoutput
+        WHERE timestamp < ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ''')
+_INSERT_PVOUTPUT = _query('pvoutput', '''
+    INSERT INTO pvoutput (
+        timestamp, need_upload,
+        v1, v2, v3, v4, v5, v6, v7, v8, v9, v10, v11, v12
+    ) VALUES (
+        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    )
+    ''')
+_REPLACE_PVOUTPUT = _query('pvoutput', '''
+    INSERT OR REPLACE INTO pvoutput (
+        timestamp, need_upload,
+        v1, v2, v3, v4, v5, v6, v7, v8, v9, v10, v11, v12
+    ) VALUES (
+        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    )
+    ''')
+_STORED_PARTITION = _query('pvoutput', '''
+    SELECT
+        timestamp, need_upload,
+        v1, v2, v3, v4, v5, v6, v7, v8, v9, v10, v11, v12
+    FROM pvoutput
+        WHERE timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp ASC
+    ''')
+_STORED_ROWS = _query('pvoutput', '''
+    SELECT timestamp, v1, v2, v3, v4, v5, v6, v7, v8, v9, v10, v11, v12
+    FROM pvoutput
+        WHERE timestamp >= ? AND timestamp < ?
+    ''')
+_EXPORT_BATCH = _query('pvoutput', '''
+    SELECT timestamp, v1, v2, v3, v4, v5, v6, v7, v8, v9, v10, v11, v12
+    FROM pvoutput
+        WHERE timestamp > ? AND timestamp < ?
+        ORDER BY timestamp ASC
+        LIMIT ?
+    ''')
+_UPLOAD_BATCH = _query('pvoutput', '''
+    SELECT * FROM pvoutput
+        WHERE need_upload = 1 AND timestamp < ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    ''')
+_UPLOADED = _query('pvoutput', '''
+    UPDATE pvoutput
+        SET need_upload = 0
+        WHERE timestamp = ?
+        AND v1 IS ? AND v2 IS ? AND v3 IS ? AND v4 IS ?
+        AND v5 IS ? AND v6 IS ? AND v7 IS ? AND v8 IS ?
+        AND v9 IS ? AND v10 IS ? AND v11 IS ? AND v12 IS ?
+    ''')
+_ANY_UPLOADS = _query('pvoutput', '''
+    SELECT 1 FROM pvoutput
+        WHERE need_upload = 1
+        LIMIT 1
+    ''')
+_COUNT_UPLOADS = _query('pvoutput', '''
+    SELECT COUNT(*) FROM pvoutput
+        WHERE need_upload = 1
+    ''')
+_MISSING_TEMPERATURES = _query('pvoutput', '''
+    SELECT timestamp FROM pvoutput
+        WHERE v5 IS NULL AND timestamp >= ? AND timestamp <= ?
+        ORDER BY timestamp ASC
+    ''')
+_FILL_IN_TEMPERATURE = _query('pvoutput', '''
+    UPDATE pvoutput
+        SET v5 = ?, need_upload = 1
+        WHERE timestamp = ?
+    ''')
+_FAKE_EXPORT_BEFORE = _query('fake_export', '''
+    SELECT timestamp, Wh_out FROM fake_export
+        WHERE timestamp < ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    ''')
+_FAKE_EXPORTS = _query('fake_export', '''
+    SELECT timestamp, Wh_out FROM fake_export
+        WHERE timestamp >= ? AND timestamp < ?
+    ''')
+_INSERT_FAKE_EXPORT = _query('fake_export', '''
+    INSERT INTO fake_export (timestamp, Wh_out)
+        VALUES (?, ?)
+    ''')
+_DELETE_FAKE_EXPORT = _query('fake_export', '''DELETE FROM fake_export WHERE timestamp = ?''')
+_LATEST_TEMPERATURE = _query('temperature', '''SELECT MAX(timestamp) FROM temperature''')
+_TEMPERATURES = _query('temperature', '''
+    SELECT timestamp, degC FROM temperature
+        WHERE timestamp >= ? AND timestamp <= ?
+        ORDER BY timestamp ASC
+    ''')
+_INSERT_TEMPERATURES = _query('temperature', '''
+    INSERT OR REPLACE INTO temperature VALUES (
+        ?, ?
+    )
+    ''')
+_SUN_TIMES = _query('sun_times', '''
+    SELECT sunrise, sunset FROM sun_times
+        WHERE day = ?
+    ''')
+_SUN_TIMES_DAYS = _query('sun_times', '''
+    SELECT day FROM sun_times
+        WHERE day >= ? AND day <= ?
+    ''')
+_INSERT_SUN_TIMES = _query('sun_times', '''
+    INSERT OR REPLACE INTO sun_times VALUES (
+        ?, ?, ?
+    )
+    ''')
+_INGEST_STATE = _query('ingest_state', '''
+    SELECT mtime, size, digest FROM ingest_state
+        WHERE source = ?
+    ''')
+_SET_INGEST_STATE = _query('ingest_state', '''
+    INSERT OR REPLACE INTO ingest_state VALUES (
+        ?, ?, ?, ?
+    )
+    ''')
+_READ_SLOT_SERIES = _query('slot_series', '''
+    SELECT
+        timestamp,
+        meter_before, Wh_in_before, Wh_out_before,
+        meter_after, Wh_in_after, Wh_out_after,
+        solar_before, Wh_gen_before, solar_after, Wh_gen_after,
+        peak_Wh_gen, Cdsp_avg, Cmos_avg, Vin_avg, fake_Wh_out,
+        source_fp
+    FROM slot_series
+        WHERE timestamp >= ? AND timestamp <= ?
+        ORDER BY timestamp ASC
+    ''')
+_WRITE_SLOT_SERIES = _query('slot_series', '''
+    INSERT OR REPLACE INTO slot_series (
+        timestamp,
+        meter_before, Wh_in_before, Wh_out_before,
+        meter_after, Wh_in_after, Wh_out_after,
+        solar_before, Wh_gen_before, solar_after, Wh_gen_after,
+        peak_Wh_gen, Cdsp_avg, Cmos_avg, Vin_avg, fake_Wh_out,
+        source_fp
+    ) VALUES (
+        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    )
+    ''')
+_SET_SLOT_FAKE = _query('slot_series', '''UPDATE slot_series SET fake_Wh_out = ? WHERE timestamp = ?''')
+_CLEAR_FAKES_FROM = _query('slot_series', '''
+    UPDATE slot_series SET fake_Wh_out = NULL
+        WHERE timestamp >= ?
+    ''')
+_CLEAR_SLOT_SERIES = _query('slot_series', '''DELETE FROM slot_series''')
+_DROP_SLOTS = _query('slot_series', '''
+    DELETE FROM slot_series
+        WHERE timestamp >= ? AND timestamp < ?
+    ''')
+_DROP_SLOTS_FROM = _query('slot_series', '''
+    DELETE FROM slot_series
+        WHERE timestamp >= ?
+    ''')
+_DROP_SLOTS_AFTER = _query('slot_series', '''
+    DELETE FROM slot_series
+        WHERE timestamp > ?
+    ''')
+_SOURCE_STATE = _query('source_state', '''
+    SELECT max_rowid FROM source_state
+        WHERE source = ?
+    ''')
+_SET_SOURCE_STATE = _query('source_state', '''
+    INSERT OR REPLACE INTO source_state (source, max_rowid)
+        VALUES (?, ?)
+    ''')
+
+
+class PVOutputStats():
+    # Time spent in (and calls to) each instrumented method, statements
+    # run against each database, and PVOutput request latencies; all
+    # cumulative, as they're written out after each pass
+
+    def __init__(self):
+        self.HTTP_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+        # The upload worker records from its own thread
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.queries = {}
+        self.requests = {}
+        self.gauges = {}
+
+    def timed(self, name, function):
+        # time.time() rather than _monotonic(), whose Python 2 fallback
+        # only counts in clock ticks
+        def timer(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_call(name, time.time() - start)
+        return timer
+
+    def add_call(self, name, seconds):
+        with self.lock:
+            call = self.calls.setdefault(name, [0, 0.0])
+            call[0] += 1
+            call[1] += seconds
+
+    def add_query(self, db):
+        with self.lock:
+            self.queries[db] = self.queries.get(db, 0) + 1
+
+    def add_request(self, path, seconds):
+        with self.lock:
+            request = self.requests.setdefault(
+                path,
+                [0, 0.0, [0] * len(self.HTTP_BUCKETS)],
+            )
+            request[0] += 1
+            request[1] += seconds
+            i = bisect.bisect_left(self.HTTP_BUCKETS, seconds)
+            if i < len(self.HTTP_BUCKETS):
+                request[2][i] += 1
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def _buckets(self, request):
+        # (upper bound, requests taking at most that long) for each bucket
+        buckets = []
+        total = 0
+        for (le, count) in zip(self.HTTP_BUCKETS, request[2]):
+            total += count
+            buckets.append(("%g" % le, total))
+        buckets.append(("+Inf", request[0]))
+        return buckets
+
+    def json(self):
+        json = _lazy_import('json')
+        with self.lock:
+            stats = {
+                'time': int(time.time()),
+                'calls': {},
+                'queries': dict(self.queries),
+                'http': {},
+                'gauges': dict(self.gauges),
+            }
+            for (name, call) in self.calls.items():
+                stats['calls'][name] = {
+                    'count': call[0],
+                    'seconds': round(call[1], 6),
+                }
+            for (path, request) in self.requests.items():
+                stats['http'][path] = {
+                    'count': request[0],
+                    'seconds': round(request[1], 6),
+                    'buckets': dict(self._buckets(request)),
+                }
+        return json.dumps(stats, sort_keys=True)
+
+    def prometheus(self):
+        with self.lock:
+            lines = [
+                '# HELP pvoutput_call_seconds_total Time spent in each phase and call',
+                '# TYPE pvoutput_call_seconds_total counter',
+            ]
+            for name in sorted(self.calls):
+                lines.append('pvoutput_call_seconds_total{call="%s"} %.6f' % (
+                    name, self.calls[name][1],
+                ))
+            lines += [
+                '# HELP pvoutput_calls_total Calls to each phase and call',
+                '# TYPE pvoutput_calls_total counter',
+            ]
+            for name in sorted(self.calls):
+                lines.append('pvoutput_calls_total{call="%s"} %d' % (
+                    name, self.calls[name][0],
+                ))
+            lines += [
+                '# HELP pvoutput_sqlite_queries_total Statements run against each database',
+                '# TYPE pvoutput_sqlite_queries_total counter',
+            ]
+            for db in sorted(self.queries):
+                lines.append('pvoutput_sqlite_queries_total{db="%s"} %d' % (
+                    db, self.queries[db],
+                ))
+            lines += [
+                '# HELP pvoutput_http_request_duration_seconds PVOutput request latency',
+                '# TYPE pvoutput_http_request_duration_seconds histogram',
+            ]
+            for path in sorted(self.requests):
+                request = self.requests[path]
+                for (le, count) in self._buckets(request):
+                    lines.append(
+                        'pvoutput_http_request_duration_seconds_bucket{path="%s",le="%s"} %d' % (
+                            path, le, count,
+                        )
+                    )
+                lines.append('pvoutput_http_request_duration_seconds_sum{path="%s"} %.6f' % (
+                    path, request[1],
+                ))
+                lines.append('pvoutput_http_request_duration_seconds_count{path="%s"} %d' % (
+                    path, request[0],
+                ))
+            for name in sorted(self.gauges):
+                lines += [
+                    '# TYPE pvoutput_%s gauge' % name,
+                    'pvoutput_%s %g' % (name, self.gauges[name]),
+                ]
+        return "\n".join(lines) + "\n"
 
 
 class PVOutputPoster():
 
-    def __init__(self):
-        # XXX Todo: Convert to argparse, or config file
-        self.METER_DB = '/data/raven.sqlite'
-        self.SOLAR_DB = '/data/solar.sqlite'
-        self.PVO_DB = '/data/pvoutput.sqlite'
-        self.WEATHER_JSON = '/data/weather.json'
-        self.TARIFF = {
+    def __init__(self, stats=None, system=None):
+        # system: this system's settings from a --config file (see
+        # _load_config); without one (or for anything it leaves out), the
+        # environment and the defaults here
+        if system is None:
+            system = {}
+        self.NAME = system.get('name', 'default')
+        self.DATA_DIR = system.get('data_dir') or os.environ.get("DATA_DIR", "/data")
+        self.METER_DB = system.get('meter_db') or os.path.join(self.DATA_DIR, 'raven.sqlite')
+        self.SOLAR_DB = system.get('solar_db') or os.path.join(self.DATA_DIR, 'solar.sqlite')
+        self.PVO_DB = system.get('pvoutput_db') or os.path.join(self.DATA_DIR, 'pvoutput.sqlite')
+        self.WEATHER_JSON = system.get('weather_json') or os.path.join(self.DATA_DIR, 'weather.json')
+        self.TARIFF = system.get('tariff') or {
             'peak': 0.3080,
             'offpeak': 0.13915,
             'peak_days': [1, 2, 3, 4, 5],
             'peak_times': [(7, 23)],
             'export': 0.065,
         }
+        self.tariff_table = None
 
         self.INTERVAL = 600
         self.MODULO = (self.INTERVAL/60)
         self.WHCONVERT = (60/self.MODULO)
 
+        # In --daemon mode, seconds after each interval boundary to run
+        self.DAEMON_DELAY = 15
+
         # Always assume some load (in W)
-        self.BASELOAD = 240
+        self.BASELOAD = system.get('baseload', 240)
 
-        self.PVO_KEY = os.environ["API_KEY"]
-        self.PVO_SYSID = os.environ["SYSTEM_ID"]
-        self.PVO_HOST = "pvoutput.org"
+        self.PVO_KEY = str(system.get('api_key') or os.environ["API_KEY"])
+        self.PVO_SYSID = str(system.get('system_id') or os.environ["SYSTEM_ID"])
+        self.PVO_HOST = system.get('host') or os.environ.get("PVO_HOST", "pvoutput.org")
         self.PVO_ADDSTATUS = "/service/r2/addstatus.jsp"
-        self.PVO_GETSTATUS = "/service/r2/getstatus.jsp"
-
-        self.pvo_db = sqlite3.connect(self.PVO_DB)
-        self.pvo_db.row_factory = sqlite3.Row
+        self.PVO_ADDBATCHSTATUS = "/service/r2/addbatchstatus.jsp"
+        # Statuses per addbatchstatus call (30, or 100 for donors);
+        # 1 posts each row on its own via addstatus
+        self.PVO_BATCH_SIZE = system.get('batch_size', 30)
+
+        # One keep-alive connection to PVOutput per run, and the rate
+        # limit as last reported by its response headers
+        self.pvo_conn = None
+        self.rate_remaining = None
+        self.rate_limit = None
+        self.rate_reset = None
+        self.PVO_TIMEOUT = 30
+
+        # Uploads are paced by a token bucket (see _refill_tokens), which
+        # spreads the calls left this hour, less UPLOAD_RESERVE, over the
+        # time until PVOutput resets the allowance. Rows from the last
+        # UPLOAD_LIVE seconds go up without waiting for a token.
+        self.UPLOAD_RESERVE = 15
+        self.UPLOAD_LIVE = 2 * self.INTERVAL
+        self.upload_tokens = 0.0
+        self.upload_tokens_at = None
+        self.upload_wait = None
+
+        # Uploads happen on a worker thread (see _upload_worker), fed
+        # through a bounded queue, and retried with exponential backoff
+        self.uploader = None
+        self.upload_queue = Queue.Queue(maxsize=1000)
+        self.UPLOAD_DONE = -1
+        self.UPLOAD_RETRY = 30
+        self.UPLOAD_RETRY_MAX = 600
+
+        # With stats ('json' or 'prometheus'), time each phase and each
+        # _lookup_*, _get_* and _post* call, count SQLite statements and
+        # PVOutput request latencies, and write them out after each pass
+        # (as a line of JSON, or a Prometheus textfile collector file)
+        self.STATS = stats
+        self.STATS_JSON = os.path.join(self.DATA_DIR, 'pvoutput-stats.jsonl')
+        self.STATS_PROM = os.path.join(self.DATA_DIR, 'pvoutput.prom')
+        self.stats = None
+        if self.STATS is not None:
+            self.stats = PVOutputStats()
+            self._instrument()
+
+        self.pvo_db = self._open_pvo_db()
         self.cursor = self.pvo_db.cursor()
+        self._init_db()
+
+        # Worker processes for recompute (None: one per CPU)
+        self.RECOMPUTE_PROCESSES = None
+
+        # Computed rows waiting for the next (batched) commit
+        self.COMMIT_SLOTS = 144
+        self.COMMIT_SECONDS = 60
+        self.pending_rows = []
+        self.pending_nets = []
+        self.pending_fake_export = []
+        self.last_commit = time.time()
+
+        # State carried from one slot to the next, so each slot doesn't
+        # go back to the databases for what the previous one worked out:
+        # the last row written (timestamp, v1, v3), the last fake export
+        # total (timestamp, Wh_out), and this run's last meter and solar
+        # lookups (timestamp, results)
+        self.last_row = None
+        self.last_fake_export = None
+        self.last_meter = None
+        self.last_solar = None
+
+        # Where the sun times are worked out for (see _location)
+        self.LOCATION = tuple(system.get('location') or (
+            'Blackburn',
+            'Victoria',
+            -37.82,
+            145.15,
+            'Australia/Melbourne',
+            50
+        ))
+        self.location = None
+
+        # Interpolated source values for a run's slots, keyed by timestamp
+        # (filled in bulk by _prefetch_source_data)
+        self.meter_series = {}
+        self.solar_series = {}
+        self.solar_peaks = {}
+        self.panel_series = {}
+        self.temp_series = {}
+        self.fake_series = {}
+        # (timestamp, the largest etot_Wh before it), carried from one of
+        # _compute's chunks to the next
+        self.solar_peak_carry = None
+        # The source rows' buckets for this run (see _source_buckets)
+        self.source_buckets = None
+
+        # What the series were worked out from, for slot_series: the
+        # readings either side of each slot (meter: timestamp, Wh_in,
+        # Wh_out; solar: timestamp, etot_Wh) read from the source
+        # databases this run, and the slots read back from slot_series
+        # (with their fake export, if they have it yet)
+        self.meter_brackets = {}
+        self.solar_brackets = {}
+        self.cached_slots = {}
+        self.pending_series = []
+        self.pending_series_fakes = []
+
+        # Sunrise/sunset by local day (see _sun_times)
+        self.SUN_CACHE_DAYS = 8
+        self.sun_times = collections.OrderedDict()
 
-        self.location = astral.Location(
-            info=(
-                'Blackburn',
-                'Victoria',
-                -37.82,
-                145.15,
-                'Australia/Melbourne',
-                50
+        # another arg
+        self.verbose = True
+
+        # Set (e.g. by SIGTERM) to finish the current pass and stop
+        self.stopping = threading.Event()
+        # Pipe used to wake watch() from its select() on a signal
+        self.wake_fds = None
+
+        # Source databases, opened once per run (see _source_db)
+        self.source_dbs = {}
+
+        # Rows read per query by export_rows
+        self.EXPORT_BATCH = 1000
+
+    def _instrument(self):
+        # Wrap the methods to be timed on this instance, so there's no cost
+        # at all when stats aren't wanted
+        names = [
+            '_ingest_temperatures',
+            '_fill_in_temperatures',
+            '_prefetch_source_data',
+            '_compute',
+            '_commit',
+            '_compute_sun_times',
+            '_precompute_sun_times',
+            '_upload',
+            '_merge_partition',
+        ]
+        for name in dir(self):
+            if ((name.startswith('_lookup_')) or
+                (name.startswith('_get_')) or
+                (name.startswith('_post'))):
+                names.append(name)
+        for name in names:
+            setattr(self, name, self.stats.timed(name.lstrip('_'), getattr(self, name)))
+
+    def _write_stats(self):
+        if self.stats is None:
+            return
+        if self.STATS == 'json':
+            with open(self.STATS_JSON, 'a') as fh:
+                fh.write(self.stats.json() + "\n")
+        else:
+            # Replaced in one go, so it's never read half-written
+            with open(self.STATS_PROM + '.tmp', 'w') as fh:
+                fh.write(self.stats.prometheus())
+            os.rename(self.STATS_PROM + '.tmp', self.STATS_PROM)
+
+    def _connect(self, path, database=None, **kwargs):
+        # sqlite3.connect() to path (or to database, a URI for it), with
+        # the statements run on the connection counted if we're keeping
+        # stats
+        if database is None:
+            database = path
+        if self.stats is None:
+            return sqlite3.connect(database, **kwargs)
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        count = lambda *args: self.stats.add_query(name)
+        if not hasattr(sqlite3.Connection, 'set_trace_callback'):
+            kwargs['factory'] = _CountingConnection
+        db = sqlite3.connect(database, **kwargs)
+        if isinstance(db, _CountingConnection):
+            db.on_query = count
+        else:
+            db.set_trace_callback(count)
+        return db
+
+    def _open_pvo_db(self):
+        # WAL lets the upload worker (and anything else reading) carry on
+        # while we write; synchronous=NORMAL is still crash-safe in WAL
+        # mode, it just doesn't fsync on every commit
+        db = self._connect(self.PVO_DB, timeout=60)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA cache_size = -4096')
+        return db
+
+    def _source_db(self, path):
+        # The collectors own raven.sqlite and solar.sqlite, so open them
+        # read-only and keep them open for the whole run. Queries are
+        # parameterised so sqlite3's statement cache can reuse them.
+        if path not in self.source_dbs:
+            self.source_dbs[path] = self._connect_read_only(path)
+        return self.source_dbs[path]
+
+    def _connect_read_only(self, path):
+        try:
+            return self._connect(
+                path,
+                'file:%s?mode=ro' % path,
+                uri=True,
+                cached_statements=32,
             )
-        )
+        except TypeError:
+            # This sqlite3 module has no URI support (Python 2)
+            db = self._connect(path, cached_statements=32)
+            db.execute('PRAGMA query_only = 1')
+            return db
+
+    def _close_source_dbs(self):
+        for db in self.source_dbs.values():
+            db.close()
+        self.source_dbs = {}
 
     def _interpolate_value(self, t1, t2, v1, v2):
         delta_t = t2 - t1
@@ -71,19 +903,289 @@ class PVOutputPoster():
         else:
             return (ordered[mid] + ordered[mid + 1]) / 2.0
 
+    def _merge_slots(self, rows, slots, peak_col=None, peak=None):
+        # Walk rows (ordered by timestamp) alongside the sorted slots, and
+        # yield (slot, before, after, peak) for each slot: the last row
+        # earlier than the slot, the first row at or after it, and the
+        # largest value of column peak_col seen before the slot.
+        slots = sorted(slots)
+        i = 0
+        before = None
+        for row in rows:
+            while i < len(slots) and slots[i] <= row[0]:
+                yield slots[i], before, row, peak
+                i += 1
+            if i == len(slots):
+                return
+            if peak_col is not None and row[peak_col] is not None:
+                if peak is None or row[peak_col] > peak:
+                    peak = row[peak_col]
+            before = row
+        for slot in slots[i:]:
+            yield slot, before, None, peak
+
+    def _interpolate_row(self, timestamp, before, after, col):
+        inter = self._interpolate_value(
+            before[0], after[0],
+            before[col], after[col],
+        )
+        return before[col] + inter * (timestamp - before[0])
+
+    def _slot_at(self, timestamp):
+        # The slot at or before timestamp
+        step = self.MODULO * 60
+        hour = timestamp - (timestamp % 3600)
+        return hour + (timestamp % 3600) // step * step
+
+    def _next_slot(self, timestamp):
+        # The first slot after timestamp (slots restart each hour, see
+        # _slots)
+        step = self.MODULO * 60
+        hour = timestamp - (timestamp % 3600)
+        return min(hour + ((timestamp % 3600) // step + 1) * step, hour + 3600)
+
+    def _peak_before(self, cursor, t):
+        # The largest etot_Wh before t, only looking at the readings since
+        # the last time where there was one (so a backfill's chunks don't
+        # each scan the whole table)
+        (since, peak) = (0, None)
+        if ((self.solar_peak_carry is not None) and
+            (self.solar_peak_carry[0] <= t)):
+            (since, peak) = self.solar_peak_carry
+        cursor.execute(_PEAK_SINCE, (since, t))
+        earlier = cursor.fetchall()[0][0]
+        if earlier is not None and (peak is None or earlier > peak):
+            peak = earlier
+        self.solar_peak_carry = (t, peak)
+        return peak
+
+    def _source_buckets(self, lo, hi):
+        # Fingerprint the source rows the slots in [lo, hi] could be
+        # worked out from: each row is bucketed with the first slot after
+        # it, and each bucket summed up (COUNT, highest rowid and TOTALs,
+        # weighted by time of day so values moved between rows count, in
+        # one string). Returns ({table: (slots, [(sums, the largest
+        # etot_Wh for system)])} for the buckets with rows in them, and the
+        # largest etot_Wh before the first system bucket).
+        step = self.MODULO * 60
+        half = self.INTERVAL / 2
+        spans = {
+            'panels': (lo - half, hi + half),
+            'demand': (lo - self.INTERVAL + 1, hi),
+        }
+        buckets = {}
+        peak = None
+        for (path, tables) in ((self.METER_DB, ('metered', 'demand')),
+                               (self.SOLAR_DB, ('system', 'panels'))):
+            cursor = self._source_db(path).cursor()
+            for table in tables:
+                if table in spans:
+                    (first, last) = spans[table]
+                else:
+                    # From the last reading before lo to the first at or
+                    # after hi, as _window
+                    cursor.execute(_SOURCE_SPAN[table], (lo, lo, hi, hi))
+                    (first, last) = cursor.fetchall()[0]
+                first = self._slot_at(first)
+                if table == 'system':
+                    peak = self._peak_before(cursor, first)
+                if self._indexed(cursor, table, 'timestamp'):
+                    cursor.execute(_BUCKETS_WALKED[table],
+                        (first, self._next_slot(first), step, step, self._next_slot(last)))
+                else:
+                    cursor.execute(_BUCKETS_GROUPED[table],
+                        (step, step, first, self._next_slot(last)))
+                # Just the buckets with rows in them, either way
+                rows = [row for row in cursor.fetchall() if row[1] is not None]
+                buckets[table] = ([row[0] for row in rows], [row[1:] for row in rows])
+            cursor.close()
+        return (buckets, peak)
+
+    def _slot_fingerprint(self, t, buckets, meter_before, meter_after, solar_before, solar_after):
+        # A checksum of the buckets (from _source_buckets) holding the
+        # rows slot t was worked out from: the meter and solar readings
+        # either side of it and everything between, the panels' readings
+        # over its +/- INTERVAL/2 window and the demand over its INTERVAL.
+        # Kept in slot_series, so rows changed, added or removed since
+        # are noticed.
+        zlib = _lazy_import('zlib')
+        half = self.INTERVAL / 2
+        parts = []
+        for (table, first, last) in (('metered', meter_before, meter_after),
+                                     ('system', solar_before, solar_after),
+                                     ('panels', t - half, t + half),
+                                     ('demand', t - self.INTERVAL + 1, t)):
+            (slots, sums) = buckets[table]
+            parts.append(sums[
+                bisect.bisect_left(slots, self._next_slot(first)):
+                bisect.bisect_right(slots, self._next_slot(last))
+            ])
+        return zlib.crc32(repr(parts))
+
+    def _read_slot_series(self, lo, hi, buckets, peak):
+        # Fill in the series for the slots in [lo, hi] found in
+        # slot_series, re-interpolating from the readings either side just
+        # as _prefetch_source_data would; returns those slots. Slots whose
+        # source rows have changed since (their fingerprint or solar peak
+        # no longer matches buckets and peak, from _source_buckets) are
+        # left to be worked out again.
+        self.cursor.execute(_READ_SLOT_SERIES, (lo, hi))
+        (slots, sums) = buckets['system']
+        i = 0
+        for row in self.cursor.fetchall():
+            row = tuple(row)
+            slot = row[0]
+            # The largest etot_Wh before the slot
+            while i < len(slots) and slots[i] <= slot:
+                if sums[i][1] is not None and (peak is None or sums[i][1] > peak):
+                    peak = sums[i][1]
+                i += 1
+            if ((row[11] != peak) or
+                (row[16] != self._slot_fingerprint(slot, buckets, row[1], row[4], row[7], row[9]))):
+                continue
+            self.meter_series[slot] = {
+                'Wh_in': self._interpolate_row(slot, row[1:4], row[4:7], 1),
+                'Wh_out': self._interpolate_row(slot, row[1:4], row[4:7], 2),
+            }
+            self.solar_series[slot] = {
+                'Wh_gen': self._interpolate_row(slot, row[7:9], row[9:11], 1),
+            }
+            self.solar_peaks[slot] = row[11]
+            self.panel_series[slot] = {}
+            for (key, value) in zip(('Cdsp_avg', 'Cmos_avg', 'Vin_avg'), row[12:15]):
+                if value is not None:
+                    self.panel_series[slot][key] = value
+            if row[15] is not None:
+                self.fake_series[slot] = row[15]
+            self.cached_slots[slot] = row[15]
+        return self.cached_slots.keys()
+
+    def _prefetch_source_data(self, slots):
+        # Interpolate the meter and solar counters for every slot (and the
+        # slot before it) with one ordered scan of each source table,
+        # rather than point queries per slot
+        if slots == []:
+            return
+        wanted = set(slots)
+        wanted.update([t - self.INTERVAL for t in slots])
+        # Slots worked out before (see _keep_slot_series), from source
+        # rows that haven't changed since, needn't be again
+        (self.source_buckets, peak) = self._source_buckets(min(wanted), max(wanted))
+        wanted.difference_update(self._read_slot_series(min(wanted), max(wanted), self.source_buckets, peak))
+        if wanted == set():
+            return
+        lo = min(wanted)
+        hi = max(wanted)
+
+        db = self._source_db(self.METER_DB)
+        cursor = db.cursor()
+        cursor.execute(_METERED_WINDOW, (lo, lo, hi, hi))
+        for slot, before, after, peak in self._merge_slots(cursor, wanted):
+            self.meter_series[slot] = {}
+            if before is None or after is None:
+                continue
+            try:
+                self.meter_series[slot] = {
+                    'Wh_in': self._interpolate_row(slot, before, after, 1),
+                    'Wh_out': self._interpolate_row(slot, before, after, 2),
+                }
+                self.meter_brackets[slot] = tuple(before[:3]) + tuple(after[:3])
+            except:
+                pass
+        cursor.close()
+
+        db = self._source_db(self.SOLAR_DB)
+        cursor = db.cursor()
+        cursor.execute(_SYSTEM_START, (lo, lo))
+        start = cursor.fetchall()[0][0]
+        peak = self._peak_before(cursor, start)
+        cursor.execute(_SYSTEM_WINDOW, (lo, lo, hi, hi))
+        for slot, before, after, peak in self._merge_slots(cursor, wanted, 2, peak):
+            self.solar_peaks[slot] = peak
+            self.solar_series[slot] = {}
+            if before is None or after is None:
+                continue
+            try:
+                self.solar_series[slot] = {
+                    'Wh_gen': self._interpolate_row(slot, before, after, 2),
+                }
+                self.solar_brackets[slot] = (before[0], before[2], after[0], after[2])
+            except:
+                pass
+
+        # Per-panel averages over each slot's +/- INTERVAL/2 window (only
+        # the slots themselves need them) in one query, rather than one
+        # per slot. Each reading is paired with the slot at or before it
+        # and the one after (a reading on the boundary of two windows
+        # counts towards both); panels is the outer loop, so avg() sums
+        # each group in timestamp order, just as the per-slot query does.
+        # That relies on every multiple of INTERVAL being a slot. Where
+        # migrate has indexed panels, the per-slot queries (each seeking
+        # straight to its window and grouping just those rows) are cheaper
+        # than grouping the whole backfill at once, so they're left to it.
+        slots = wanted.intersection(slots)
+        if ((slots != set()) and
+            (3600 % self.INTERVAL == 0) and
+            (not self._indexed(cursor, 'panels', 'timestamp'))):
+            half = self.INTERVAL / 2
+            cursor.execute(_PANELS_BATCH, (
+                self.INTERVAL, self.INTERVAL,
+                min(slots) - half, max(slots) + half,
+                self.INTERVAL, half, self.INTERVAL, half,
+            ))
+            values = []
+            for row in cursor:
+                if values != [] and values[0][0] != row[0]:
+                    self._finish_panel_slot(slots, values)
+                    values = []
+                values.append(row)
+            self._finish_panel_slot(slots, values)
+            for slot in slots:
+                if slot not in self.panel_series:
+                    self.panel_series[slot] = {}
+        cursor.close()
+
+    def _indexed(self, cursor, table, column):
+        # Whether table has an index that leads with column
+        cursor.execute('''PRAGMA index_list(%s)''' % table)
+        for index in cursor.fetchall():
+            cursor.execute('''PRAGMA index_info(%s)''' % index[1])
+            for info in cursor.fetchall():
+                if info[0] == 0 and info[2] == column:
+                    return True
+        return False
+
+    def _finish_panel_slot(self, slots, values):
+        # Keep the medians for a slot's (slot, macrf, Tdsp, Tmos, Vin) rows
+        if values != [] and values[0][0] in slots:
+            self.panel_series[values[0][0]] = self._panel_medians(
+                [row[1:] for row in values]
+            )
+
+    def _panel_medians(self, values):
+        # The medians across panels of their average temperatures and
+        # voltage, from (macrf, Tdsp, Tmos, Vin) rows; as many of them as
+        # can be worked out (none without any panels reporting)
+        results = {}
+        try:
+            results['Cdsp_avg'] = self._median([v[1] for v in values])
+            results['Cmos_avg'] = self._median([v[2] for v in values])
+            results['Vin_avg'] = self._median([v[3] for v in values])
+        except:
+            pass
+        return results
+
     def _lookup_meter_data(self, timestamp):
+        if timestamp in self.meter_series:
+            return dict(self.meter_series[timestamp])
+
         results = {}
 
         # Metering data
-        db = sqlite3.connect(self.METER_DB)
+        db = self._source_db(self.METER_DB)
         cursor = db.cursor()
 
-        cursor.execute('''
-            SELECT * FROM metered
-                WHERE timestamp < %d
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''' % timestamp)
+        cursor.execute(_METERED_BEFORE, (timestamp,))
         values = cursor.fetchall()
         if values == []:
             return {}
@@ -95,12 +1197,7 @@ class PVOutputPoster():
             return {}
 
         first_time = values[0][0]
-        cursor.execute('''
-            SELECT * FROM metered
-                WHERE timestamp >= %d
-                ORDER BY timestamp ASC
-                LIMIT 1
-            ''' % timestamp)
+        cursor.execute(_METERED_AFTER, (timestamp,))
         values = cursor.fetchall()
         if values == []:
             return {}
@@ -123,16 +1220,21 @@ class PVOutputPoster():
             return {}
 
         cursor.close()
-        db.close()
 
         return results
 
     def _get_meter_data(self, timestamp):
         results = self._lookup_meter_data(timestamp)
+        previous = self.last_meter
+        self.last_meter = (timestamp, results)
         if results == {}:
             return results
 
-        previous_results = self._lookup_meter_data(timestamp - self.INTERVAL)
+        if ((previous is not None) and
+            (previous[0] == timestamp - self.INTERVAL)):
+            previous_results = previous[1]
+        else:
+            previous_results = self._lookup_meter_data(timestamp - self.INTERVAL)
         if 'Wh_in' in previous_results:
             results['prev_Wh_in'] = previous_results['Wh_in'] 
         if 'Wh_out' in previous_results:
@@ -141,33 +1243,28 @@ class PVOutputPoster():
         return results
 
     def _lookup_max_solar_data(self, timestamp):
+        if timestamp in self.solar_peaks:
+            return self.solar_peaks[timestamp]
+
         results = {}
 
         # Solar data
-        db = sqlite3.connect(self.SOLAR_DB)
+        db = self._source_db(self.SOLAR_DB)
         cursor = db.cursor()
 
-        cursor.execute('SELECT MAX(etot_Wh) FROM system WHERE timestamp < %d' % timestamp)
+        cursor.execute(_PEAK_BEFORE, (timestamp,))
         values = cursor.fetchall()
+        cursor.close()
 
         try:
             return values[0][0]
         except:
             return None
 
-    def _lookup_solar_data(self, timestamp):
+    def _lookup_solar_gen(self, cursor, timestamp):
         results = {}
 
-        # Solar data
-        db = sqlite3.connect(self.SOLAR_DB)
-        cursor = db.cursor()
-
-        cursor.execute('''
-            SELECT * FROM system
-                WHERE timestamp < %d
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''' % timestamp)
+        cursor.execute(_SYSTEM_BEFORE, (timestamp,))
         values = cursor.fetchall()
         if values == []:
             return {}
@@ -179,12 +1276,7 @@ class PVOutputPoster():
 
         # Find point #2
         first_time = values[0][0]
-        cursor.execute('''
-            SELECT * FROM system
-                WHERE timestamp >= %d
-                ORDER BY timestamp ASC
-                LIMIT 1
-            ''' % timestamp)
+        cursor.execute(_SYSTEM_AFTER, (timestamp,))
         values = cursor.fetchall()
         if values == []:
             return {}
@@ -201,42 +1293,53 @@ class PVOutputPoster():
         except:
             return {}
 
-        try:
-            # Temperature & voltage data
-            cursor.execute('''
-                SELECT macrf, avg(Tdsp_degC), avg(Tmos_degC), avg(Vin_V) FROM panels
-                    WHERE (timestamp >= %d) AND (timestamp <= %d)
-                    GROUP BY macrf;
-                ''' % (
+        return results
+
+    def _lookup_solar_data(self, timestamp, panels=True):
+        # Solar data
+        db = self._source_db(self.SOLAR_DB)
+        cursor = db.cursor()
+
+        if timestamp in self.solar_series:
+            results = dict(self.solar_series[timestamp])
+        else:
+            results = self._lookup_solar_gen(cursor, timestamp)
+        if results == {} or not panels:
+            cursor.close()
+            return results
+
+        # Temperature & voltage data
+        if timestamp in self.panel_series:
+            results.update(self.panel_series[timestamp])
+        else:
+            try:
+                cursor.execute(_PANELS_WINDOW, (
                     timestamp - (self.INTERVAL / 2),
                     timestamp + (self.INTERVAL / 2),
                 ))
-            values = cursor.fetchall()
-            t_dsp = []
-            t_mos = []
-            v_in = []
-            for v in values:
-                t_dsp.append(v[1])
-                t_mos.append(v[2])
-                v_in.append(v[3])
-            results['Cdsp_avg'] = self._median(t_dsp)
-            results['Cmos_avg'] = self._median(t_mos)
-            results['Vin_avg'] = self._median(v_in)
-        except:
-            pass
+                self.panel_series[timestamp] = self._panel_medians(cursor.fetchall())
+            except:
+                self.panel_series[timestamp] = {}
+            results.update(self.panel_series[timestamp])
 
         cursor.close()
-        db.close()
 
         return results
 
     def _get_solar_data(self, timestamp):
         results = self._lookup_solar_data(timestamp)
+        previous = self.last_solar
+        self.last_solar = (timestamp, results)
         if results == {}:
             return results
 
         max = self._lookup_max_solar_data(timestamp - self.INTERVAL)
-        previous_results = self._lookup_solar_data(timestamp - self.INTERVAL)
+        if ((previous is not None) and
+            (previous[0] == timestamp - self.INTERVAL)):
+            previous_results = previous[1]
+        else:
+            # Only the generation is wanted from the slot before
+            previous_results = self._lookup_solar_data(timestamp - self.INTERVAL, False)
         if 'Wh_gen' in previous_results:
             results['prev_Wh_gen'] = previous_results['Wh_gen']
             if results['prev_Wh_gen'] < max:
@@ -245,44 +1348,238 @@ class PVOutputPoster():
         return results
 
     def _fake_Wh_out(self, timestamp):
+        if timestamp in self.fake_series:
+            return self.fake_series[timestamp]
+
         # Meter data
-        db = sqlite3.connect(self.METER_DB)
+        db = self._source_db(self.METER_DB)
         cursor = db.cursor()
-        cursor.execute('''
-            SELECT avg(watts) FROM demand
-                WHERE (timestamp > ?) AND (timestamp <= ?) AND (watts < 0)
-            ''', ((timestamp - self.INTERVAL), timestamp)
-        )
+        cursor.execute(_DEMAND_EXPORT, ((timestamp - self.INTERVAL), timestamp))
         value = cursor.fetchall()
         cursor.close()
-        db.close()
 
+        if value == [] or value[0][0] is None:
+            self.fake_series[timestamp] = 0
+        else:
+            # Wh convert convert
+            self.fake_series[timestamp] = (value[0][0] / float(self.WHCONVERT)) * (-1)
+        return self.fake_series[timestamp]
+
+    def _location(self):
+        # Only made (and astral imported) for days not already in the
+        # sun_times table
+        if self.location is None:
+            astral = _lazy_import('astral')
+            self.location = astral.Location(info=self.LOCATION)
+        return self.location
+
+    def _compute_sun_times(self, day):
+        # Sunrise and sunset for a local date, as epoch seconds; rounded
+        # inwards so whole-second timestamps compare as they would
+        # against the exact times
+        location = self._location()
+        sr = location.sunrise(day)
+        ss = location.sunset(day)
+        sunrise = calendar.timegm(sr.utctimetuple())
+        if sr.microsecond:
+            sunrise += 1
+        sunset = calendar.timegm(ss.utctimetuple())
+        return (sunrise, sunset)
+
+    def _sun_times(self, timestamp):
+        # (sunrise, sunset) for the local day of timestamp, from a small
+        # LRU cache backed by the sun_times table
+        day = datetime.date.fromtimestamp(timestamp).isoformat()
+        if day in self.sun_times:
+            times = self.sun_times.pop(day)
+        else:
+            self.cursor.execute(_SUN_TIMES, (day,))
+            times = self.cursor.fetchall()
+            if times != []:
+                times = (times[0][0], times[0][1])
+            else:
+                times = self._compute_sun_times(
+                    datetime.date.fromtimestamp(timestamp)
+                )
+                self.cursor.execute(_INSERT_SUN_TIMES, (day, times[0], times[1]))
+            if len(self.sun_times) >= self.SUN_CACHE_DAYS:
+                self.sun_times.popitem(last=False)
+        self.sun_times[day] = times
+        return times
+
+    def _precompute_sun_times(self, t_start, t_end):
+        # Work out (and store) sun times for every day of a backfill up
+        # front, skipping days already in the sun_times table
+        first = datetime.date.fromtimestamp(t_start)
+        last = datetime.date.fromtimestamp(t_end)
+        self.cursor.execute(_SUN_TIMES_DAYS, (first.isoformat(), last.isoformat()))
+        known = set([row[0] for row in self.cursor.fetchall()])
+        missing = []
+        day = first
+        while day <= last:
+            if day.isoformat() not in known:
+                times = self._compute_sun_times(day)
+                missing.append((day.isoformat(), times[0], times[1]))
+            day += datetime.timedelta(1)
+        self.cursor.executemany(_INSERT_SUN_TIMES, missing)
+
+    def _tariff_rate(self, periods, month, day, hour, default):
+        # First period matching the month (1-12), day (0 = Sunday) and hour;
+        # a period without 'months', 'days' or 'hours' matches any
+        for period in periods:
+            if (('months' in period) and
+                (month not in period['months'])):
+                continue
+            if (('days' in period) and
+                (day not in period['days'])):
+                continue
+            if 'hours' in period:
+                for hours in period['hours']:
+                    if ((hour >= hours[0]) and
+                        (hour < hours[1])):
+                        break
+                else:
+                    continue
+            return period['rate']
+        return default
+
+    def _compile_tariff(self):
+        # Flatten TARIFF into (import, export) rates for every hour of the
+        # week in every month.  Besides the peak/offpeak keys, TARIFF can
+        # list extra import 'rates' periods (shoulder, seasonal, ...) that
+        # take precedence, and 'export' can be a list of periods too.
+        imports = list(self.TARIFF.get('rates', []))
+        if 'peak' in self.TARIFF:
+            imports.append({
+                'rate': self.TARIFF['peak'],
+                'days': self.TARIFF['peak_days'],
+                'hours': self.TARIFF['peak_times'],
+            })
+        exports = self.TARIFF['export']
+        if not isinstance(exports, list):
+            exports = [{'rate': exports}]
+
+        table = []
+        for month in xrange(1, 13):
+            for day in xrange(7):
+                for hour in xrange(24):
+                    table.append((
+                        self._tariff_rate(imports, month, day, hour, self.TARIFF['offpeak']),
+                        self._tariff_rate(exports, month, day, hour, 0),
+                    ))
+        self.tariff_table = table
+
+    def _tariff_index(self, ts):
+        # Where the local time ts (a time.struct_time) is in tariff_table
+        day = (ts.tm_wday + 1) % 7
+        return (((ts.tm_mon - 1) * 7) + day) * 24 + ts.tm_hour
+
+    def _tariff_indices(self, timestamps):
+        # _tariff_index() of each of timestamps, looking local time up once
+        # per hour rather than per timestamp: an hour that starts and ends
+        # in the same local hour (the time zone offset is whole hours, and
+        # doesn't change part way through it) has the one index
+        hours = {}
+        indices = []
+        for timestamp in timestamps:
+            hour = timestamp - (timestamp % 3600)
+            index = hours.get(hour)
+            if index is None:
+                first = time.localtime(hour)
+                last = time.localtime(hour + 3599)
+                if ((first.tm_hour == last.tm_hour) and
+                    (first.tm_yday == last.tm_yday)):
+                    index = self._tariff_index(first)
+                else:
+                    index = -1
+                hours[hour] = index
+            if index == -1:
+                index = self._tariff_index(time.localtime(timestamp))
+            indices.append(index)
+        return indices
+
+    def _cost(self, net, timestamp):
+        # Cost (in $) of net Wh imported (or exported, if negative) in the
+        # interval ending at timestamp
+        if self.tariff_table is None:
+            self._compile_tariff()
+        rates = self.tariff_table[self._tariff_index(time.localtime(timestamp))]
+        if net < 0:
+            return (net / 1000.0) * rates[1]
+        return (net / 1000.0) * rates[0]
+
+    def _costs(self, nets, timestamps):
+        # _cost() of each of nets with the matching one of timestamps, all
+        # at once (a commit's worth of slots, a recomputed day, ...)
+        if self.tariff_table is None:
+            self._compile_tariff()
+        costs = []
+        for (net, index) in zip(nets, self._tariff_indices(timestamps)):
+            rates = self.tariff_table[index]
+            if net < 0:
+                costs.append((net / 1000.0) * rates[1])
+            else:
+                costs.append((net / 1000.0) * rates[0])
+        return costs
+
+    def _cost_rows(self, rows, nets):
+        # rows (as from _insert_pvoutput) with v9 filled in from the cost of
+        # each one's net Wh (None where there's no cost)
+        costed = [i for (i, net) in enumerate(nets) if net is not None]
+        costs = self._costs([nets[i] for i in costed], [rows[i][0] for i in costed])
+        rows = list(rows)
+        for (i, cost) in zip(costed, costs):
+            rows[i] = rows[i][:10] + (float("%.2f" % (cost * 100)),) + rows[i][11:]
+        return rows
+
+    def _cost_entries(self, entries, nets):
+        # _cost_rows() for (row, fake export total) entries
+        rows = self._cost_rows([row for (row, fake) in entries], nets)
+        return zip(rows, [fake for (row, fake) in entries])
+
+    def _previous_row(self, timestamp):
+        # (timestamp, v1, v3) of the last row before timestamp; normally
+        # the row we wrote last (which may not be flushed yet), so only
+        # the first slot after startup has to look it up
+        if ((self.last_row is not None) and
+            (self.last_row[0] < timestamp)):
+            return self.last_row
+        return self._stored_row(timestamp)
+
+    def _stored_row(self, timestamp):
+        self.cursor.execute(_ROW_BEFORE, (timestamp,))
+        value = self.cursor.fetchall()
         if value == []:
-            return 0
-        if value[0][0] is None:
-            return 0
-        
-        # Wh convert convert
-        return (value[0][0] / float(self.WHCONVERT)) * (-1)
+            return None
+        return tuple(value[0])
+
+    def _previous_fake_export(self, timestamp):
+        # (timestamp, Wh_out) of the last fake export total before
+        # timestamp, as for _previous_row()
+        if ((self.last_fake_export is not None) and
+            (self.last_fake_export[0] < timestamp)):
+            return self.last_fake_export
+        return self._stored_fake_export(timestamp)
+
+    def _stored_fake_export(self, timestamp):
+        self.cursor.execute(_FAKE_EXPORT_BEFORE, (timestamp,))
+        value = self.cursor.fetchall()
+        if value == []:
+            return None
+        return tuple(value[0])
 
     def _calculate_pvoutput(self, timestamp, data):
         pvoutput = {}
+        net = None
 
-        # Have the prev v1 value at hand
-        self.cursor.execute('''
-            SELECT timestamp, v1 FROM pvoutput
-                WHERE timestamp < %d
-                ORDER BY timestamp DESC
-                LIMIT 1
-        ''' % (timestamp)
-        )
-        value = self.cursor.fetchall()
-        if value == []:
+        # Have the prev v1 (and v3) value at hand
+        previous = self._previous_row(timestamp)
+        if previous is None:
             prev_v1 = 0
             prev_v1_ts = 0
         else:
-            prev_v1 = value[0][1]
-            prev_v1_ts = value[0][0]
+            prev_v1 = previous[1]
+            prev_v1_ts = previous[0]
 
         if 'Wh_gen' in data:
             # If the CDD solar basestation is restarted, it resets to 0Wh
@@ -308,22 +1605,17 @@ class PVOutputPoster():
             # Don't "generate" before sunrise (could happen if we have gaps in data)
             # (with 10 minutes grace...)
             if data['Wh_gen'] != data['prev_Wh_gen']:
-                ts = time.localtime(timestamp)
-                day = datetime.date(ts.tm_year, ts.tm_mon, ts.tm_mday)
-                dt = datetime.datetime.fromtimestamp(
-                    timestamp,
-                    self.location.sunset(day).tzinfo
-                )
-                sr = self.location.sunrise(day)
-                sr_adj = sr - datetime.timedelta(0, self.INTERVAL)
-                ss = self.location.sunset(day)
-                ss_adj = ss + datetime.timedelta(0, self.INTERVAL)
-                if dt > ss_adj:
+                (sr, ss) = self._sun_times(timestamp)
+                sr_adj = sr - self.INTERVAL
+                ss_adj = ss + self.INTERVAL
+                if timestamp > ss_adj:
                     print "ERROR: generation after sunset setting to prev. value"
                     data['Wh_gen'] = prev_v1
                     data['prev_Wh_gen'] = prev_v1
-                elif dt < sr_adj:
-                    print "ERROR: generation before sunrise (%s)" % sr_adj
+                elif timestamp < sr_adj:
+                    print "ERROR: generation before sunrise (%s)" % (
+                        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sr_adj))
+                    )
                     print "timestamp=%s; prev_Wh_gen=%s; Wh_gen=%s" % (
                         timestamp,
                         data['prev_Wh_gen'],
@@ -342,26 +1634,15 @@ class PVOutputPoster():
         if 'prev_Wh_out' in data:
 #            if int(data['prev_Wh_out']) == 0:
             if int(data['prev_Wh_out']) == 0 or (timestamp - self.INTERVAL >= 1416315600 and timestamp - self.INTERVAL < 1416402000):
-                self.cursor.execute('''
-                    SELECT Wh_out FROM fake_export
-                        WHERE timestamp < %d
-                        ORDER BY timestamp DESC
-                        LIMIT 1
-                ''' % (timestamp)
-                )
-                value = self.cursor.fetchall()
-                if value == []:
+                fake = self._previous_fake_export(timestamp)
+                if fake is None:
                     data['prev_Wh_out'] = 0
                 else:
-                    data['prev_Wh_out'] = value[0][0]
+                    data['prev_Wh_out'] = fake[1]
                 data['Wh_out'] += data['prev_Wh_out']
-                self.cursor.execute('''
-                    INSERT INTO fake_export (timestamp, Wh_out)
-                        VALUES (%d, %d)
-                ''' % (
-                    timestamp,
-                    data['Wh_out']
-                ))
+                # Written along with the pvoutput rows by _commit()
+                self.last_fake_export = (timestamp, int(data['Wh_out']))
+                self.pending_fake_export.append(self.last_fake_export)
 
         # Calculate consumption in Wh (param v3)
         # consumption = generation + import - export
@@ -373,19 +1654,11 @@ class PVOutputPoster():
             )
 
             # previous value
-            self.cursor.execute('''
-                SELECT v3 FROM pvoutput
-                    WHERE timestamp < %d
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-            ''' % (timestamp)
-            )
-            value = self.cursor.fetchall()
-            if ((value == []) or \
-                (value[0][0] == None)):
+            if ((previous is None) or \
+                (previous[2] == None)):
                 data['prev_Wh_cons'] = 0
             else:
-                data['prev_Wh_cons'] = value[0][0]
+                data['prev_Wh_cons'] = previous[2]
 
             if 'v3' in pvoutput:
                 # If current consumption is less than baseload, then adjust
@@ -421,19 +1694,9 @@ class PVOutputPoster():
                 gen = data['Wh_gen'] - data['prev_Wh_gen']
                 con = int(pvoutput['v3']) - data['prev_Wh_cons']
                 net = con - gen
-                day = int(time.strftime("%w", time.localtime(timestamp)))
-                hour = int(time.strftime("%H", time.localtime(timestamp)))
-                rate = self.TARIFF['offpeak']
-                if day in self.TARIFF['peak_days']:
-                    for period in self.TARIFF['peak_times']:
-                        if ((hour >= period[0]) and
-                            (hour < period[1])):
-                            rate = self.TARIFF['peak']
-                            break
-                cost = (net / 1000.0) * rate
-                if net < 0:
-                    cost = (net / 1000.0) * self.TARIFF['export']
-                pvoutput['v9'] = "%.2f" % (cost * 100)
+                # v9 is worked out from it along with the other rows
+                # waiting to be written (see _cost_rows)
+                pvoutput['net'] = net
 
         if self.verbose:
             sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)))
@@ -459,8 +1722,7 @@ class PVOutputPoster():
                 ))
             if net is not None:
                 sys.stdout.write("; net=%dWh" % net)
-            if 'v9' in pvoutput:
-                sys.stdout.write("; cost=%sc" % pvoutput['v9'])
+                sys.stdout.write("; cost=%.2fc" % (self._cost(net, timestamp) * 100))
             print ""
 
         if (('v1' in pvoutput) or
@@ -469,72 +1731,306 @@ class PVOutputPoster():
         
         return None
 
-    def _upload(self):
-        try:
-            headers = {
-                'X-Pvoutput-Apikey': self.PVO_KEY,
-                'X-Pvoutput-SystemId': self.PVO_SYSID,
-                'X-Rate-Limit': '1',
-            }
-            conn = httplib.HTTPConnection(self.PVO_HOST)
-            conn.request("GET", self.PVO_GETSTATUS, None, headers)
-            response = conn.getresponse()
-            remaining = response.getheader('x-rate-limit-remaining')
-            if remaining is not None:
-                remaining = int(remaining)
-                if remaining <= 15:
-                    print "ERROR: less than 15 API calls remaining"
-                    return
+    def _upload(self, partial=True):
+        # Runs on the upload worker thread, with its own connection to
+        # pvoutput.sqlite. Returns False if PVOutput couldn't be reached.
+        # Without partial, a short final batch is left for later (so a
+        # backfill in progress doesn't burn API calls on small batches).
+        if ((self.rate_reset is not None) and
+            (time.time() >= self.rate_reset)):
+            # The hourly allowance has been reset since we last heard
+            self.rate_remaining = None
+
+        # Find stuff to upload, newest first so live data isn't held up
+        # behind a backlog (a batch of statuses costs one API call),
+        # re-checking the rate limit reported by the previous response
+        # before each call
+        batch_size = max(self.PVO_BATCH_SIZE, 1)
+        last = sys.maxint
+        while True:
+            if ((self.rate_remaining is not None) and
+                (self.rate_remaining <= self.UPLOAD_RESERVE)):
+                print "ERROR: less than %d API calls remaining" % self.UPLOAD_RESERVE
+                self._report_backlog()
+                return True
+
+            self.ul_cursor.execute(_UPLOAD_BATCH, (last, batch_size))
+            rows = self.ul_cursor.fetchall()
+            if rows == []:
+                if self.stats is not None:
+                    self.stats.set_gauge('upload_backlog_rows', 0)
+                    self.stats.set_gauge('upload_drain_seconds', 0)
+                return True
+            if len(rows) < batch_size and not partial:
+                return True
+            rate = self._refill_tokens()
+            if ((self.upload_tokens < 1) and
+                (rows[0]['timestamp'] < time.time() - self.UPLOAD_LIVE)):
+                # Come back for the rest when the next token is due
+                if rate > 0:
+                    self.upload_wait = (1 - self.upload_tokens) / rate
+                else:
+                    self.upload_wait = max(self.rate_reset - time.time(), 1)
+                self._report_backlog()
+                return True
+            self.upload_tokens -= 1
+            last = rows[-1]['timestamp']
+            statuses = [(row, self._status(row)) for row in rows]
+
+            if batch_size == 1:
+                (row, pvoutput) = statuses[0]
+                posted = self._post(pvoutput)
+                if posted is None:
+                    return False
+                if posted:
+                    self._mark_uploaded(row)
+                    print "Posted %s %s" % (pvoutput['d'], pvoutput['t'])
             else:
+                added = self._post_batch([pvoutput for (row, pvoutput) in statuses])
+                if added is None:
+                    return False
+                for (row, pvoutput) in statuses:
+                    if (pvoutput['d'], pvoutput['t']) in added:
+                        self._mark_uploaded(row)
+                        print "Posted %s %s" % (pvoutput['d'], pvoutput['t'])
+            # Don't hold the write lock over the next request
+            self.ul_db.commit()
+
+            if self.rate_remaining is None:
                 print "ERROR: didn't get a x-rate-limit-remaining result"
-                return
-        except Exception as e:
-            print "ERROR: When quering API limit: %s" % str(e)
-            return
+                return True
 
-        # Find stuff to upload
-        self.cursor.execute('''
-            SELECT * FROM pvoutput
-                WHERE need_upload = 1
-                ORDER BY timestamp ASC
-                LIMIT %d
-            ''' % (remaining - 15)
+    def _status(self, row):
+        pvoutput = {}
+        for col in row.keys():
+            if ((col != 'timestamp') and
+                (col != 'need_upload')
+            ):
+                if row[col] is not None:
+                    pvoutput[col] = row[col]
+        pvoutput['d'] = time.strftime("%Y%m%d", time.localtime(row['timestamp']))
+        pvoutput['t'] = time.strftime("%H:%M", time.localtime(row['timestamp']))
+        pvoutput['c1'] = "1"
+        # print "-> %s %s" % (pvoutput['d'], pvoutput['t'])
+        return pvoutput
+
+    def _mark_uploaded(self, row):
+        # Unless the row has changed since it was read (e.g. filled in with
+        # a temperature while it was being posted), in which case it's
+        # left to go up again as it is now
+        self.ul_cursor.execute(_UPLOADED, (
+            row['timestamp'],
+            row['v1'], row['v2'], row['v3'], row['v4'],
+            row['v5'], row['v6'], row['v7'], row['v8'],
+            row['v9'], row['v10'], row['v11'], row['v12'],
+        ))
+
+    def _upload_rate(self):
+        # API calls a second that spread what's left of this hour's
+        # allowance (less UPLOAD_RESERVE) evenly until it's reset, or None
+        # if PVOutput hasn't said
+        if self.rate_remaining is None or self.rate_reset is None:
+            return None
+        return max(self.rate_remaining - self.UPLOAD_RESERVE, 0) / float(
+            max(self.rate_reset - time.time(), 1))
+
+    def _refill_tokens(self):
+        # Add the tokens (API calls) earned since the last refill at the
+        # current rate, keeping at most an INTERVAL's worth, so each pass
+        # can send its share straight away (a new bucket starts full).
+        # Until PVOutput has told us the rate, one call at a time.
+        now = _monotonic()
+        rate = self._upload_rate()
+        if rate is None:
+            self.upload_tokens = max(self.upload_tokens, 1)
+            return rate
+        if self.upload_tokens_at is None:
+            earned = rate * self.INTERVAL
+        else:
+            earned = rate * (now - self.upload_tokens_at)
+        self.upload_tokens = min(
+            self.upload_tokens + earned,
+            max(rate * self.INTERVAL, 1),
         )
-        rows = self.cursor.fetchall()
-        for row in rows:
-            pvoutput = {}
-            for col in row.keys():
-                if ((col != 'timestamp') and
-                    (col != 'need_upload')
-                ):
-                    if row[col] is not None:
-                        pvoutput[col] = row[col]
-            pvoutput['d'] = time.strftime("%Y%m%d", time.localtime(row['timestamp']))
-            pvoutput['t'] = time.strftime("%H:%M", time.localtime(row['timestamp']))
-            pvoutput['c1'] = "1"
-            # print "-> %s %s" % (pvoutput['d'], pvoutput['t'])
-
-            if self._post(pvoutput):
-                self.cursor.execute('''
-                    UPDATE pvoutput
-                        SET need_upload = 0
-                        WHERE timestamp = %d
-                ''' % row['timestamp'])
-                print "Posted %s %s" % (pvoutput['d'], pvoutput['t'])
+        self.upload_tokens_at = now
+        return rate
+
+    def _drain_seconds(self, rows):
+        # Roughly how long the rows waiting will take to go up at the
+        # current pace: the rest of this hour's allowance, then a full
+        # allowance (less UPLOAD_RESERVE) an hour; None if PVOutput hasn't
+        # told us its limits
+        rate = self._upload_rate()
+        if rate is None or self.rate_limit is None:
+            return None
+        calls = -(-rows // max(self.PVO_BATCH_SIZE, 1))
+        if calls == 0:
+            return 0
+        now_calls = max(self.rate_remaining - self.UPLOAD_RESERVE, 0)
+        if rate > 0 and calls <= now_calls:
+            return calls / rate
+        hourly = max(self.rate_limit - self.UPLOAD_RESERVE, 1)
+        return (max(self.rate_reset - time.time(), 0) +
+                (calls - now_calls) * 3600.0 / hourly)
+
+    def _report_backlog(self):
+        # How many rows are still waiting, and how long they'll take
+        self.ul_cursor.execute(_COUNT_UPLOADS)
+        rows = self.ul_cursor.fetchall()[0][0]
+        seconds = self._drain_seconds(rows)
+        if seconds is None:
+            print "%d rows waiting to upload" % rows
+        else:
+            print "%d rows waiting to upload; about %d minutes to go" % (
+                rows, -(-int(seconds) // 60))
+        if self.stats is not None:
+            self.stats.set_gauge('upload_backlog_rows', rows)
+            if seconds is not None:
+                self.stats.set_gauge('upload_drain_seconds', round(seconds))
+
+    def _request(self, method, path, params=None):
+        # Send a request over the persistent connection, reconnecting if
+        # the server has dropped it. Returns (response, body).
+        httplib = _lazy_import('httplib')
+        socket = _lazy_import('socket')
+        urllib = _lazy_import('urllib')
+        headers = {
+            'X-Pvoutput-Apikey': self.PVO_KEY,
+            'X-Pvoutput-SystemId': self.PVO_SYSID,
+            'X-Rate-Limit': '1',
+            "Accept": "*/*",
+        }
+        body = None
+        if params is not None:
+            body = urllib.urlencode(params)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        start = time.time()
+        while True:
+            reused = self.pvo_conn is not None
+            if not reused:
+                self.pvo_conn = httplib.HTTPConnection(
+                    self.PVO_HOST,
+                    timeout=self.PVO_TIMEOUT,
+                )
+            try:
+                self.pvo_conn.request(method, path, body, headers)
+                response = self.pvo_conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                # Only a kept-alive connection is worth another go
+                self._close_connection()
+                if not reused:
+                    raise
+                continue
+            if response.getheader('connection', '').lower() == 'close':
+                self._close_connection()
+            self._track_rate_limit(response)
+            if self.stats is not None:
+                self.stats.add_request(path, time.time() - start)
+            return (response, data)
+
+    def _track_rate_limit(self, response):
+        remaining = response.getheader('x-rate-limit-remaining')
+        if remaining is not None:
+            self.rate_remaining = int(remaining)
+        limit = response.getheader('x-rate-limit-limit')
+        if limit is not None:
+            self.rate_limit = int(limit)
+        reset = response.getheader('x-rate-limit-reset')
+        if reset is not None:
+            self.rate_reset = int(reset)
+
+    def _upload_worker(self):
+        # Drain need_upload rows whenever the compute side queues some,
+        # backing off while PVOutput can't be reached
+        self.ul_db = self._open_pvo_db()
+        self.ul_cursor = self.ul_db.cursor()
+
+        backoff = None
+        wait = None
+        done = False
+        while not done:
+            try:
+                items = [self.upload_queue.get(timeout=wait)]
+            except Queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self.upload_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if self.UPLOAD_DONE in items:
+                done = True
+                if self.stopping.is_set():
+                    break
+
+            # Rows queued mid-pass only go up in full batches; the nudge
+            # at the end of a pass (or a retry) sends whatever is left
+            partial = done or items == [] or None in items
+            self.upload_wait = None
+            try:
+                try:
+                    uploaded = self._upload(partial)
+                finally:
+                    self.ul_db.commit()
+            except Exception:
+                # Don't lose the worker (and every later upload) to one
+                # bad pass; try again after a backoff
+                print "ERROR: upload pass failed"
+                _lazy_import('traceback').print_exc()
+                uploaded = False
+            if uploaded:
+                backoff = None
+            elif backoff is None:
+                backoff = self.UPLOAD_RETRY
+            else:
+                backoff = min(backoff * 2, self.UPLOAD_RETRY_MAX)
+            # Back again once PVOutput might be reachable, or when the
+            # next token is due for rows still waiting
+            wait = backoff
+            if self.upload_wait is not None and (wait is None or self.upload_wait < wait):
+                wait = self.upload_wait
+
+        self._close_connection()
+        self.ul_cursor.close()
+        self.ul_db.close()
+
+    def _upload_waiting(self):
+        self.cursor.execute(_ANY_UPLOADS)
+        return self.cursor.fetchall() != []
+
+    def _queue_upload(self, item=None):
+        # Hand rows (or just a nudge) to the upload worker, starting it if
+        # need be; never blocks, as the worker rescans need_upload anyway
+        if self.uploader is None:
+            self.uploader = threading.Thread(target=self._upload_worker, name=self.NAME)
+            self.uploader.daemon = True
+            self.uploader.start()
+        try:
+            self.upload_queue.put_nowait(item)
+        except Queue.Full:
+            pass
 
-    def _post(self, params):
+    def _finish_uploads(self):
+        # Wait for the worker to make a last pass over need_upload rows
+        # (skipped when we've been signalled to stop)
+        if self.uploader is None:
+            return
+        self.upload_queue.put(self.UPLOAD_DONE)
+        self.uploader.join()
+        self.uploader = None
+
+    def _close_connection(self):
+        if self.pvo_conn is not None:
+            self.pvo_conn.close()
+            self.pvo_conn = None
 
+    def _post(self, params):
+        # Whether addstatus.jsp took the status, or None if the request
+        # failed
         try:
-            headers = {
-                'X-Pvoutput-Apikey': self.PVO_KEY,
-                'X-Pvoutput-SystemId': self.PVO_SYSID,
-                "Accept": "*/*",
-                "Content-Type": "application/x-www-form-urlencoded",
-            }
-            conn = httplib.HTTPConnection(self.PVO_HOST)
-            conn.request("POST", self.PVO_ADDSTATUS, urllib.urlencode(params), headers)
-            response = conn.getresponse()
-            conn.close()
+            (response, body) = self._request("POST", self.PVO_ADDSTATUS, params)
             if response.status == 200:
                 return True
             else:
@@ -545,53 +2041,252 @@ class PVOutputPoster():
                 return False
         except Exception as e:
             print "Exception with HTTP POST: %s" % str(e)
-            return False
+            return None
+
+    def _post_batch(self, statuses):
+        # addbatchstatus.jsp takes "d,t,v1,...,v12" statuses separated by
+        # ';', and replies with "d,t,added" for each of them; returns the
+        # statuses it reports as added, or None if the request failed
+        data = []
+        for status in statuses:
+            fields = [status['d'], status['t']]
+            for i in xrange(1, 13):
+                fields.append(str(status.get('v%d' % i, '')))
+            data.append(','.join(fields).rstrip(','))
+        params = {
+            'data': ';'.join(data),
+            'c1': "1",
+        }
+
+        try:
+            (response, body) = self._request("POST", self.PVO_ADDBATCHSTATUS, params)
+            if response.status != 200:
+                print "HTTP POST Failed: code %d; reason %s" % (
+                    response.status,
+                    response.reason,
+                )
+                return set()
+        except Exception as e:
+            print "Exception with HTTP POST: %s" % str(e)
+            return None
+
+        added = set()
+        for result in body.strip().split(';'):
+            result = result.split(',')
+            if len(result) < 3:
+                continue
+            if result[2].strip() == '1':
+                added.add((result[0].strip(), result[1].strip()))
+            else:
+                print "Status %s %s not added by PVOutput" % (
+                    result[0].strip(),
+                    result[1].strip(),
+                )
+
+        return added
 
     def _init_db(self):
-        self.cursor.execute('''
-            CREATE TABLE pvoutput (
-                timestamp INTEGER PRIMARY KEY,
-                v1 INTEGER,
-                v2 INTEGER,
-                v3 INTEGER,
-                v4 INTEGER,
-                v5 INTEGER,
-                v6 INTEGER,
-                v7 INTEGER,
-                v8 INTEGER,
-                v9 INTEGER,
-                v10 INTEGER,
-                v11 INTEGER,
-                v12 INTEGER,
-                need_upload INTEGER NOT NULL
-            )
-        ''')
-        self.cursor.execute('''CREATE INDEX need_ul ON pvoutput (need_upload)''')
-        self.cursor.execute('''CREATE INDEX has_temp ON pvoutput (v5)''')
-        self.cursor.execute('''
-            CREATE TABLE temperature (
-                timestamp INTEGER PRIMARY KEY,
-                degC REAL NOT NULL
-            )
-        ''')
+        # Bring pvoutput.sqlite's schema up to date. PRAGMA user_version
+        # counts the migrations applied; each is safe to re-run (Python
+        # 2's sqlite3 commits before DDL, so one can be cut short), and
+        # databases from before user_version was kept may already have
+        # some of it.
+        migrations = [
+            [
+                '''
+                CREATE TABLE IF NOT EXISTS pvoutput (
+                    timestamp INTEGER PRIMARY KEY,
+                    v1 INTEGER,
+                    v2 INTEGER,
+                    v3 INTEGER,
+                    v4 INTEGER,
+                    v5 INTEGER,
+                    v6 INTEGER,
+                    v7 INTEGER,
+                    v8 INTEGER,
+                    v9 INTEGER,
+                    v10 INTEGER,
+                    v11 INTEGER,
+                    v12 INTEGER,
+                    need_upload INTEGER NOT NULL
+                )
+                ''',
+                '''CREATE INDEX IF NOT EXISTS need_ul ON pvoutput (need_upload)''',
+                '''CREATE INDEX IF NOT EXISTS has_temp ON pvoutput (v5)''',
+                '''
+                CREATE TABLE IF NOT EXISTS temperature (
+                    timestamp INTEGER PRIMARY KEY,
+                    degC REAL NOT NULL
+                )
+                ''',
+                '''
+                CREATE TABLE IF NOT EXISTS fake_export (
+                    timestamp INTEGER PRIMARY KEY,
+                    Wh_out INTEGER
+                )
+                ''',
+            ],
+            [
+                '''
+                CREATE TABLE IF NOT EXISTS ingest_state (
+                    source TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    digest TEXT NOT NULL
+                )
+                ''',
+                '''
+                CREATE TABLE IF NOT EXISTS sun_times (
+                    day TEXT PRIMARY KEY,
+                    sunrise INTEGER NOT NULL,
+                    sunset INTEGER NOT NULL
+                )
+                ''',
+            ],
+            [
+                # Just the rows waiting to be uploaded, in upload order
+                '''
+                CREATE INDEX IF NOT EXISTS need_ul_ts ON pvoutput (timestamp)
+                    WHERE need_upload = 1
+                ''',
+                '''DROP INDEX IF EXISTS need_ul''',
+            ],
+            [
+                # What each computed slot was worked out from (see
+                # _keep_slot_series): the meter and solar readings either
+                # side of it, the solar peak before it, the panel medians
+                # and the fake export
+                '''
+                CREATE TABLE IF NOT EXISTS slot_series (
+                    timestamp INTEGER PRIMARY KEY,
+                    meter_before INTEGER NOT NULL,
+                    Wh_in_before INTEGER NOT NULL,
+                    Wh_out_before INTEGER NOT NULL,
+                    meter_after INTEGER NOT NULL,
+                    Wh_in_after INTEGER NOT NULL,
+                    Wh_out_after INTEGER NOT NULL,
+                    solar_before INTEGER NOT NULL,
+                    Wh_gen_before INTEGER NOT NULL,
+                    solar_after INTEGER NOT NULL,
+                    Wh_gen_after INTEGER NOT NULL,
+                    peak_Wh_gen INTEGER,
+                    Cdsp_avg REAL,
+                    Cmos_avg REAL,
+                    Vin_avg REAL,
+                    fake_Wh_out REAL
+                )
+                ''',
+                # The highest rowid of each source table as of the last
+                # _sync_slot_series
+                '''
+                CREATE TABLE IF NOT EXISTS source_state (
+                    source TEXT PRIMARY KEY,
+                    max_rowid INTEGER NOT NULL
+                )
+                ''',
+            ],
+            [
+                # slot_series again, with a fingerprint of the source rows
+                # each slot was worked out from (see _slot_fingerprint);
+                # the slots are worked out again as they're needed
+                '''DROP TABLE IF EXISTS slot_series''',
+                '''
+                CREATE TABLE slot_series (
+                    timestamp INTEGER PRIMARY KEY,
+                    meter_before INTEGER NOT NULL,
+                    Wh_in_before INTEGER NOT NULL,
+                    Wh_out_before INTEGER NOT NULL,
+                    meter_after INTEGER NOT NULL,
+                    Wh_in_after INTEGER NOT NULL,
+                    Wh_out_after INTEGER NOT NULL,
+                    solar_before INTEGER NOT NULL,
+                    Wh_gen_before INTEGER NOT NULL,
+                    solar_after INTEGER NOT NULL,
+                    Wh_gen_after INTEGER NOT NULL,
+                    peak_Wh_gen INTEGER,
+                    Cdsp_avg REAL,
+                    Cmos_avg REAL,
+                    Vin_avg REAL,
+                    fake_Wh_out REAL,
+                    source_fp INTEGER
+                )
+                ''',
+            ],
+        ]
+
+        self.cursor.execute('''PRAGMA user_version''')
+        version = self.cursor.fetchall()[0][0]
+        for statements in migrations[version:]:
+            for statement in statements:
+                self.cursor.execute(statement)
+            version += 1
+            self.cursor.execute('''PRAGMA user_version = %d''' % version)
+            self.pvo_db.commit()
 
     def _get_last_entry(self):
-        self.cursor.execute('''SELECT timestamp FROM pvoutput ORDER BY timestamp DESC LIMIT 1''')
+        self.cursor.execute(_LAST_ENTRY)
         db_time = self.cursor.fetchall()
         if db_time == []:
             return 1411603200
         else:
             return db_time[0][0]
 
+    def _get_ingest_state(self, source):
+        self.cursor.execute(_INGEST_STATE, (source,))
+        state = self.cursor.fetchall()
+        if state == []:
+            return None
+        return tuple(state[0])
+
+    def _set_ingest_state(self, source, mtime, size, digest):
+        self.cursor.execute(_SET_INGEST_STATE, (source, mtime, size, digest))
+
+    def _parse_bom_time(self, stamp):
+        # BOM's aifstime_utc is always YYYYMMDDHHMMSS
+        if len(stamp) != 14:
+            raise ValueError("bad BOM time: %s" % stamp)
+        return calendar.timegm((
+            int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]),
+            int(stamp[8:10]), int(stamp[10:12]), int(stamp[12:14]),
+        ))
+
     def _get_temperature_data(self):
+        # Skip weather.json entirely if it's the same file we ingested
+        # last time (same mtime and size, or failing that the same hash)
+        st = os.stat(self.WEATHER_JSON)
+        state = self._get_ingest_state(self.WEATHER_JSON)
+        if ((state is not None) and
+            (state[0] == st.st_mtime) and
+            (state[1] == st.st_size)):
+            return {}
+        hashlib = _lazy_import('hashlib')
+        json = _lazy_import('json')
         with open(self.WEATHER_JSON, 'rb') as fh:
-            data = json.load(fh)['observations']['data']
+            raw = fh.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if ((state is not None) and
+            (state[2] == digest)):
+            self._set_ingest_state(self.WEATHER_JSON, st.st_mtime, st.st_size, digest)
+            return {}
+        try:
+            data = json.loads(raw)['observations']['data']
+        except ValueError as e:
+            # Most likely caught while it's being written; it's read
+            # again (not having been recorded as ingested) next time
+            print "weather.json isn't ready yet: %s" % str(e)
+            return {}
+        self._set_ingest_state(self.WEATHER_JSON, st.st_mtime, st.st_size, digest)
+
+        # Only observations newer than what we already have
+        self.cursor.execute(_LATEST_TEMPERATURE)
+        latest = self.cursor.fetchall()[0][0]
+
         temps = {}
         for obs in data:
             try:
-                epoch = calendar.timegm(
-                    time.strptime(obs['aifstime_utc'], "%Y%m%d%H%M%S")
-                )
+                epoch = self._parse_bom_time(obs['aifstime_utc'])
+                if latest is not None and epoch <= latest:
+                    continue
                 temps["%.0f" % epoch] = obs['air_temp']
             except:
                 print "ERROR: Issue with BOM data"
@@ -599,150 +2294,1120 @@ class PVOutputPoster():
         return temps
 
     def _update_temperature_db(self, temps):
+        # Store the observations in one go, and return the (first, last)
+        # timestamps among them, or None if there were none
+        new = {}
         for temp in temps:
             if temps[temp] is None:
                 continue
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO temperature VALUES (
-                    ?, ?
-                )
-            ''', (temp, temps[temp],)
-            )
-
-    def _get_temp(self, timestamp):
-        self.cursor.execute('''
-            SELECT * FROM temperature
-                WHERE timestamp <= %d
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''' % timestamp)
-        try:
-            first_value = self.cursor.fetchall()[0]
-            if (timestamp - first_value[0]) > 3600:
-                return None
-            elif (timestamp - first_value[0]) == 0:
-                return first_value[1]
-        except:
+            new[int(temp)] = temps[temp]
+        if new == {}:
             return None
 
-        self.cursor.execute('''
-            SELECT * FROM temperature
-                WHERE timestamp > %d
-                ORDER BY timestamp ASC
-                LIMIT 1
-            ''' % timestamp)
-        try:
-            second_value = self.cursor.fetchall()[0]
-            if (second_value[0] - timestamp) > 3600:
-                return None
-            elif (second_value[0] - timestamp) == 0:
-                return second_value[1]
+        self.cursor.executemany(_INSERT_TEMPERATURES, sorted(new.items()))
+        return (min(new), max(new))
+
+    def _get_temps(self, timestamps):
+        # Air temperature at each of the given timestamps, interpolated
+        # between the observations either side (None if the nearest one
+        # on either side is more than an hour away), from one sorted load
+        # of the temperature table
+        if len(timestamps) == 0:
+            return []
+        self.cursor.execute(_TEMPERATURES, (min(timestamps) - 3600, max(timestamps) + 3600))
+        times = []
+        temps = []
+        for row in self.cursor.fetchall():
+            times.append(row[0])
+            temps.append(row[1])
+
+        results = []
+        for timestamp in timestamps:
+            # times[i - 1] <= timestamp < times[i]
+            i = bisect.bisect_right(times, timestamp)
+            if ((i == 0) or
+                ((timestamp - times[i - 1]) > 3600)):
+                results.append(None)
+            elif (timestamp - times[i - 1]) == 0:
+                results.append(temps[i - 1])
+            elif ((i == len(times)) or
+                  ((times[i] - timestamp) > 3600)):
+                results.append(None)
+            else:
+                inter_t = self._interpolate_value(
+                    times[i - 1], times[i],
+                    temps[i - 1], temps[i],
+                )
+                ts_diff = timestamp - times[i - 1]
+                results.append(temps[i - 1] + (inter_t * ts_diff))
 
-            inter_t = self._interpolate_value(
-                first_value[0], second_value[0],
-                first_value[1], second_value[1],
-            )
-            ts_diff = timestamp - first_value[0]
-            return first_value[1] + (inter_t * ts_diff)
-        except:
-            return None
+        return results
+
+    def _get_temp(self, timestamp):
+        if timestamp in self.temp_series:
+            return self.temp_series[timestamp]
+        return self._get_temps([timestamp])[0]
+
+    def _slots(self, t_start, t_end):
+        # Yield every timestamp in [t_start, t_end) that falls on a whole
+        # minute divisible by MODULO (UTC), without visiting every second.
+        # Slots restart at the top of each hour, so this also holds when
+        # MODULO doesn't divide 60 evenly.
+        step = self.MODULO * 60
+        hour = t_start - (t_start % 3600)
+        while hour < t_end:
+            for t in xrange(hour, min(hour + 3600, t_end), step):
+                if t >= t_start:
+                    yield t
+            hour += 3600
 
     def _fill_in_temperatures(self, t_start, t_end):
-        self.cursor.execute('''
-            SELECT timestamp FROM pvoutput
-                WHERE v5 is NULL''')
-        nov5 = self.cursor.fetchall()
-        for row in nov5:
-            temp = self._get_temp(row[0])
+        # Only rows within an hour of the observations stored in
+        # [t_start, t_end] can have gained a temperature, so don't rescan
+        # the rest of history (much of which can never be filled)
+        self.cursor.execute(_MISSING_TEMPERATURES, (t_start - 3600, t_end + 3600))
+        nov5 = [row[0] for row in self.cursor.fetchall()]
+        updates = []
+        for timestamp, temp in zip(nov5, self._get_temps(nov5)):
             if temp is None:
                 continue
-            self.cursor.execute('''
-                UPDATE pvoutput
-                    SET v5 = %.1f, need_upload = 1
-                    WHERE timestamp = %d
-            ''' % (temp, row[0]))
-
-    def main(self):
-
-        # make an argparse option?
-        # self._init_db()
-        # exit(1)
-
-        # another arg
-        self.verbose = True
+            updates.append((float("%.1f" % temp), timestamp))
+
+        self.cursor.executemany(_FILL_IN_TEMPERATURE, updates)
+
+    def _insert_pvoutput(self, timestamp, pvoutput):
+        # Rows are buffered, and written in one executemany by _commit()
+        row = [timestamp, 1]
+        for i in xrange(1, 13):
+            value = pvoutput.get('v%d' % i)
+            if value is not None:
+                try:
+                    value = int(value)
+                except ValueError:
+                    value = float(value)
+            row.append(value)
+        self.pending_rows.append(tuple(row))
+        self.pending_nets.append(pvoutput.get('net'))
+        self.last_row = (timestamp, row[2], row[4])
+
+    def _keep_slot_series(self, t):
+        # Queue what slot t was worked out from for slot_series, if it was
+        # all read from the source databases this run; a slot read back
+        # from slot_series may only be missing its fake export
+        if t in self.cached_slots:
+            if self.cached_slots[t] is None and t in self.fake_series:
+                self.pending_series_fakes.append((self.fake_series[t], t))
+            return
+        if t not in self.meter_brackets or t not in self.solar_brackets:
+            return
+        panels = self.panel_series.get(t, {})
+        self.pending_series.append(
+            (t,) +
+            self.meter_brackets[t] +
+            self.solar_brackets[t] +
+            (
+                self.solar_peaks.get(t),
+                panels.get('Cdsp_avg'),
+                panels.get('Cmos_avg'),
+                panels.get('Vin_avg'),
+                self.fake_series.get(t),
+                self._slot_fingerprint(
+                    t, self.source_buckets,
+                    self.meter_brackets[t][0], self.meter_brackets[t][3],
+                    self.solar_brackets[t][0], self.solar_brackets[t][2],
+                ),
+            )
+        )
 
+    def _take_slot_series(self):
+        # The slot_series rows (and fake exports) queued so far, as
+        # (rows, fakes); they're no longer queued here
+        taken = (self.pending_series, self.pending_series_fakes)
+        self.pending_series = []
+        self.pending_series_fakes = []
+        return taken
+
+    def _write_slot_series(self, taken):
+        (rows, fakes) = taken
+        if rows != []:
+            self.cursor.executemany(_WRITE_SLOT_SERIES, rows)
+        if fakes != []:
+            self.cursor.executemany(_SET_SLOT_FAKE, fakes)
+
+    def _commit(self):
+        self._write_slot_series(self._take_slot_series())
+        if self.pending_rows != []:
+            self.cursor.executemany(_INSERT_PVOUTPUT, self._cost_rows(self.pending_rows, self.pending_nets))
+        if self.pending_fake_export != []:
+            self.cursor.executemany(_INSERT_FAKE_EXPORT, self.pending_fake_export)
+        self.pvo_db.commit()
+        for row in self.pending_rows:
+            self._queue_upload(row[0])
+        self.pending_rows = []
+        self.pending_nets = []
+        self.pending_fake_export = []
+        self.last_commit = time.time()
+
+    def _maybe_commit(self):
+        # Commit every COMMIT_SLOTS slots or COMMIT_SECONDS seconds; a
+        # restart resumes from the last committed slot, so nothing is lost
+        # but the time to recompute them
+        if ((len(self.pending_rows) >= self.COMMIT_SLOTS) or
+            ((time.time() - self.last_commit) >= self.COMMIT_SECONDS)):
+            self._commit()
+
+    def _ingest_temperatures(self):
         temps = self._get_temperature_data()
+        new_temps = None
         if temps != {}:
-            self._update_temperature_db(temps)
+            new_temps = self._update_temperature_db(temps)
+        # Rows computed from here on pick up the new observations as they're
+        # inserted; existing rows are filled in now, so the ingest state,
+        # observations and fill-in go in as one transaction and a crash
+        # can't leave rows that will never be filled
+        if new_temps is not None:
+            self._fill_in_temperatures(new_temps[0], new_temps[1])
+        self.pvo_db.commit()
 
-        t_start = int(self._get_last_entry() + 60)
-        t_end = int(time.time() - (self.INTERVAL))
+    def _compute_slots(self, slots):
+        # Yield (timestamp, pvoutput) for each of slots with data to work
+        # from (pvoutput is None if nothing could be worked out); the
+        # caller stores each row before asking for the next
+        self._prefetch_source_data(slots)
+        self.temp_series = dict(zip(slots, self._get_temps(slots)))
 
-        for t in range(t_start, t_end):
-            if (((int(time.strftime("%M", time.gmtime(t))) % self.MODULO) != 0) or
-                ((int(time.strftime("%S", time.gmtime(t))) != 0))):
-                continue
-            # print time.strftime("%Y%m%d %H:%M", time.localtime(t))
+        try:
+            for t in slots:
+                if self.stopping.is_set():
+                    break
+                # print time.strftime("%Y%m%d %H:%M", time.localtime(t))
+
+                meter = self._get_meter_data(t).items()
+                solar = self._get_solar_data(t).items()
+                # At this point, meter & solar are lists with tuples
+
+                if (((solar == []) or (meter == [])) and \
+                    (t > (time.time() - 24 * 60 * 60))):
+                    # if solar or meter has no data, and
+                    # 't' is not more than 24-hours ago, then
+                    # wait for data (i.e. up to 24 hours for data to appear)
+                    sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
+                    if solar == []:
+                        sys.stdout.write("; (no solar data)")
+                    if meter == []:
+                        sys.stdout.write("; (no meter data)")
+                    print "; waiting..."
+                    continue
+
+                data = dict(
+                    meter +
+                    solar
+                )
 
-            meter = self._get_meter_data(t).items()
-            solar = self._get_solar_data(t).items()
-            # At this point, meter & solar are lists with tuples
+                pvoutput = self._calculate_pvoutput(t, data)
+                self._keep_slot_series(t)
+                yield (t, pvoutput)
+        finally:
+            # Only good for this run
+            self.meter_series = {}
+            self.solar_series = {}
+            self.solar_peaks = {}
+            self.panel_series = {}
+            self.temp_series = {}
+            self.fake_series = {}
+            self.meter_brackets = {}
+            self.solar_brackets = {}
+            self.cached_slots = {}
+            self.source_buckets = None
+            self.last_meter = None
+            self.last_solar = None
+
+    def _sync_slot_series(self):
+        # Drop what slot_series has for the slots that rows added to the
+        # source tables since the last sync (those past the highest rowid
+        # seen then) could change. A table whose highest rowid has gone
+        # down has been rewritten, so nothing from it can be trusted.
+        # Changes to existing rows can't be seen this way: recompute
+        # --refresh works its days out from the source tables again.
+        sources = [
+            (self.METER_DB, 'metered'),
+            (self.METER_DB, 'demand'),
+            (self.SOLAR_DB, 'system'),
+            (self.SOLAR_DB, 'panels'),
+        ]
+        for (path, table) in sources:
+            db = self._source_db(path)
+            max_rowid = db.execute(_MAX_ROWID[table]).fetchall()[0][0]
+            if max_rowid is None:
+                max_rowid = 0
+            self.cursor.execute(_SOURCE_STATE, (table,))
+            seen = self.cursor.fetchall()
+            if seen == [] or max_rowid < seen[0][0]:
+                self.cursor.execute(_CLEAR_SLOT_SERIES)
+            elif max_rowid > seen[0][0]:
+                # (+timestamp, so only the new rows are read rather than
+                # the whole timestamp index)
+                first = db.execute(_FIRST_NEW_ROW[table], (seen[0][0],)).fetchall()[0][0]
+                if table == 'panels':
+                    # The medians of the slots whose windows reach it
+                    self.cursor.execute(_DROP_SLOTS_FROM, (first - self.INTERVAL / 2,))
+                elif table == 'demand':
+                    self.cursor.execute(_CLEAR_FAKES_FROM, (first,))
+                else:
+                    # Every slot after the last reading before it is
+                    # interpolated across it (or has it in its peak)
+                    last = db.execute(_LAST_BEFORE[table], (first,)).fetchall()[0][0]
+                    if last is None:
+                        self.cursor.execute(_CLEAR_SLOT_SERIES)
+                    else:
+                        self.cursor.execute(_DROP_SLOTS_AFTER, (last,))
+            if seen == [] or max_rowid != seen[0][0]:
+                self.cursor.execute(_SET_SOURCE_STATE, (table, max_rowid))
+
+    def _compute(self, t_start, t_end):
+        slots = list(self._slots(t_start, t_end))
+        # Source rows may have come in since the last pass
+        self.solar_peak_carry = None
+        if slots != []:
+            self._precompute_sun_times(slots[0], slots[-1])
+            self._sync_slot_series()
+
+        # COMMIT_SLOTS at a time, so only a chunk's source data is held
+        # however long the backfill
+        for i in xrange(0, len(slots), self.COMMIT_SLOTS):
+            if self.stopping.is_set():
+                break
+            for (t, pvoutput) in self._compute_slots(slots[i:i + self.COMMIT_SLOTS]):
+                if pvoutput is None:
+                    sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
+                    print "; (pvoutput is None)"
+                    self.close()
+                    sys.exit(51)
+                else:
+                    self._insert_pvoutput(t, pvoutput)
+                    self._maybe_commit()
 
-            if (((solar == []) or (meter == [])) and \
-                (t > (time.time() - 24 * 60 * 60))):
-                # if solar or meter has no data, and
-                # 't' is not more than 24-hours ago, then
-                # wait for data (i.e. up to 24 hours for data to appear)
-                sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
-                if solar == []:
-                    sys.stdout.write("; (no solar data)")
-                if meter == []:
-                    sys.stdout.write("; (no meter data)")
-                print "; waiting..."
-                self.pvo_db.commit()
-                continue
+        self._commit()
 
-            data = dict(
-                meter +
-                solar
-            )
+    def run(self, t_end=None):
+        # One pass: ingest, compute new slots (up to t_end, by default an
+        # INTERVAL ago), fill in temperatures and upload. Connections and
+        # caches are left open for the next pass.
+        self._ingest_temperatures()
+
+        # Re-read the last row each pass, in case a recompute has since
+        # rewritten it
+        self.last_row = None
+        self.last_fake_export = None
 
-            pvoutput = self._calculate_pvoutput(t, data)
+        t_start = int(self._get_last_entry() + 60)
+        if t_end is None:
+            t_end = int(time.time() - (self.INTERVAL))
+        self._compute(t_start, t_end)
+        if self.stopping.is_set():
+            return
+
+        # Retry anything still waiting, even if nothing new was computed
+        # (without starting the upload worker if there's nothing)
+        if self.uploader is not None or self._upload_waiting():
+            self._queue_upload()
+
+    def _carry(self, last_row, last_fake_export):
+        # What the next slot's calculation depends on from the slots
+        # before it
+        if last_fake_export is None:
+            return (last_row, 0)
+        return (last_row, last_fake_export[1])
+
+    def _entry_row(self, entry):
+        # (timestamp, v1, v3), as for _previous_row()
+        row = entry[0]
+        return (row[0], row[2], row[4])
+
+    def _entry_carry(self, entry):
+        return self._carry(self._entry_row(entry), entry[1])
+
+    def _compute_partition(self, t_start, t_end, last_row, last_fake_export):
+        # Recompute [t_start, t_end) carrying on from the given state, as
+        # a list of (row, fake export total) entries, without writing
+        # anything
+        self.last_row = last_row
+        self.last_fake_export = last_fake_export
+        entries = []
+        nets = []
+        for (t, pvoutput) in self._compute_slots(list(self._slots(t_start, t_end))):
             if pvoutput is None:
                 sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
                 print "; (pvoutput is None)"
-                self.pvo_db.commit()
-                self.cursor.close()
-                self.pvo_db.close()
                 sys.exit(51)
-            else:
-                cols = "timestamp, need_upload, "
-                data = "%s, 1, " % t
-                for key in pvoutput:
-                    if ((key == 'c1') or
-                        (key == 'd') or
-                        (key == 't')
-                    ):
-                        continue
-                    cols += "%s, " % key
-                    data += '%s, ' % pvoutput[key]
-                self.cursor.execute(
-                '''
-                    INSERT INTO pvoutput (%s)
-                        VALUES (%s)
-                    ''' % (cols[:-2], data[:-2])
-                )
-                self.pvo_db.commit()
-
-        self._fill_in_temperatures((t_end - (4 * 24 * 60 * 60)), t_end)
+            self._insert_pvoutput(t, pvoutput)
+            entries.append((self.pending_rows.pop(), self.last_fake_export))
+            nets.append(self.pending_nets.pop())
+        self.pending_fake_export = []
+        return self._cost_entries(entries, nets)
+
+    def _refit_partition(self, t_start, t_end, entries, last_row, last_fake_export):
+        # entries were worked out for [t_start, t_end) from a different
+        # state than the one it really follows on from: recompute it in
+        # order from the right one, until the state after a slot agrees
+        # with entries again (from there on, they're right as they are)
+        self.last_row = last_row
+        self.last_fake_export = last_fake_export
+        refitted = []
+        nets = []
+        rest = []
+        for (t, pvoutput) in self._compute_slots(list(self._slots(t_start, t_end))):
+            if pvoutput is None:
+                sys.stdout.write("%s" % time.strftime("%Y-%m-%d %H:%M", time.localtime(t)))
+                print "; (pvoutput is None)"
+                sys.exit(51)
+            self._insert_pvoutput(t, pvoutput)
+            refitted.append((self.pending_rows.pop(), self.last_fake_export))
+            nets.append(self.pending_nets.pop())
+            i = len(refitted) - 1
+            if ((i < len(entries)) and
+                (entries[i][0][0] == t) and
+                (self._entry_carry(entries[i]) == self._entry_carry(refitted[i]))):
+                rest = entries[i + 1:]
+                break
+        self.pending_fake_export = []
+        return self._cost_entries(refitted, nets) + rest
+
+    def _stored_partition(self, t_start, t_end):
+        # The rows stored for [t_start, t_end), as entries
+        self.cursor.execute(_FAKE_EXPORTS, (t_start, t_end))
+        fakes = dict((row[0], tuple(row)) for row in self.cursor.fetchall())
+        fake = self._stored_fake_export(t_start)
+        self.cursor.execute(_STORED_PARTITION, (t_start, t_end))
+        entries = []
+        for row in self.cursor.fetchall():
+            fake = fakes.get(row[0], fake)
+            entries.append((tuple(row), fake))
+        return entries
+
+    def _merge_partition(self, t_start, t_end, entries):
+        # Write recomputed entries, rewriting (and flagging for upload)
+        # only the rows that have changed
+        self.cursor.execute(_STORED_ROWS, (t_start, t_end))
+        stored = dict((row[0], tuple(row)[1:]) for row in self.cursor.fetchall())
+        changed = []
+        for (row, fake) in entries:
+            if stored.get(row[0]) != row[2:]:
+                changed.append((row[0], 1) + row[2:])
+        self.cursor.executemany(_REPLACE_PVOUTPUT, changed)
+
+        # Each slot's own fake export total, if it has one
+        self.cursor.executemany(_DELETE_FAKE_EXPORT, [(row[0],) for (row, fake) in entries])
+        self.cursor.executemany(_INSERT_FAKE_EXPORT, [
+            fake for (row, fake) in entries if fake is not None and fake[0] == row[0]
+        ])
+        self._write_slot_series(self._take_slot_series())
         self.pvo_db.commit()
-       
-        self._upload()
-        
+        print "%s; %d slots, %d changed" % (
+            time.strftime("%Y-%m-%d", time.localtime(t_start)),
+            len(entries),
+            len(changed),
+        )
+
+    def _days(self, t_start, t_end):
+        # [t_start, t_end) split at local midnight
+        days = []
+        while t_start < t_end:
+            day = datetime.date.fromtimestamp(t_start) + datetime.timedelta(1)
+            end = min(int(time.mktime(day.timetuple())), t_end)
+            days.append((t_start, end))
+            t_start = end
+        return days
+
+    def recompute(self, first_day, last_day=None, refresh=False):
+        # Rebuild the rows already computed from first_day to last_day
+        # (e.g. after changing BASELOAD or the tariff, or fixing source
+        # data), a day per worker process, flagging only rows that come
+        # out different for upload. Slots are worked out from slot_series
+        # where its fingerprint of the source rows still matches; with
+        # refresh, from the source tables regardless.
+        #
+        # Each day is seeded from the stored row (and fake export total)
+        # before it. Where the day before has changed in a way that
+        # matters, the day is fixed up in order from the new state until
+        # it agrees with what the worker computed; likewise, the days
+        # after last_day are carried on with until they agree with what's
+        # stored.
+        self.cursor.execute(_FIRST_ENTRY)
+        t_first = self.cursor.fetchall()[0][0]
+        if t_first is None:
+            print "Nothing computed yet"
+            self.close()
+            return
+        t_start = max(int(time.mktime(first_day.timetuple())), t_first)
+        t_last = int(self._get_last_entry()) + 1
+        if last_day is None:
+            t_end = t_last
+        else:
+            t_end = int(time.mktime((last_day + datetime.timedelta(1)).timetuple()))
+            t_end = min(t_end, t_last)
+        days = self._days(t_start, t_end)
+        if days == []:
+            print "Nothing computed in that range"
+            self.close()
+            return
+
+        self._precompute_sun_times(t_start, t_end - 1)
+        self._sync_slot_series()
+        if refresh:
+            # Including the slot before, which the first one depends on
+            self.cursor.execute(_DROP_SLOTS, (t_start - self.INTERVAL, t_end))
         self.pvo_db.commit()
+        partitions = []
+        for (start, end) in days:
+            partitions.append((
+                start, end,
+                self._stored_row(start), self._stored_fake_export(start),
+            ))
+        stored_after = self._carry(self._stored_row(t_end), self._stored_fake_export(t_end))
+
+        self._close_source_dbs()
+        multiprocessing = _lazy_import('multiprocessing')
+        pool = multiprocessing.Pool(
+            self.RECOMPUTE_PROCESSES,
+            _recompute_init,
+            (self,),
+        )
+        try:
+            last_row = partitions[0][2]
+            last_fake_export = partitions[0][3]
+            # Merged in order, as each day (and those before it) is done
+            results = pool.imap(_recompute_partition, partitions)
+            for (i, (code, entries, series)) in enumerate(results):
+                (start, end, seed_row, seed_fake) = partitions[i]
+                if code != 0:
+                    self.close()
+                    sys.exit(code)
+                self.pending_series.extend(series[0])
+                self.pending_series_fakes.extend(series[1])
+                if self._carry(last_row, last_fake_export) != self._carry(seed_row, seed_fake):
+                    entries = self._refit_partition(start, end, entries, last_row, last_fake_export)
+                self._merge_partition(start, end, entries)
+                if entries != []:
+                    last_row = self._entry_row(entries[-1])
+                    last_fake_export = entries[-1][1]
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # Carry on past last_day until the stored rows agree
+        while ((t_end < t_last) and
+               (self._carry(last_row, last_fake_export) != stored_after)):
+            (start, end) = self._days(t_end, t_last)[0]
+            stored_after = self._carry(self._stored_row(end), self._stored_fake_export(end))
+            entries = self._stored_partition(start, end)
+            entries = self._refit_partition(start, end, entries, last_row, last_fake_export)
+            self._merge_partition(start, end, entries)
+            if entries != []:
+                last_row = self._entry_row(entries[-1])
+                last_fake_export = entries[-1][1]
+            t_end = end
+
+        self.close()
+
+    def close(self):
+        if self.pvo_db is None:
+            return
+        self._commit()
+        self._finish_uploads()
+        self._close_source_dbs()
         self.cursor.close()
         self.pvo_db.close()
+        self.pvo_db = None
+        self._write_stats()
+
+    def _stop(self, signum, frame):
+        print "Caught signal %d; stopping after this pass" % signum
+        self.stopping.set()
+        if self.wake_fds is not None:
+            os.write(self.wake_fds[1], 'x')
+
+    def _wait_until(self, wakeup):
+        # Sleep until the wall-clock time wakeup, timing the sleep on the
+        # monotonic clock so clock steps don't stretch or cut it short;
+        # returns early if we're asked to stop
+        deadline = _monotonic() + (wakeup - time.time())
+        while not self.stopping.is_set():
+            remaining = deadline - _monotonic()
+            if remaining <= 0:
+                break
+            self.stopping.wait(remaining)
+
+    def daemon(self):
+        # Stay resident, running shortly after each INTERVAL boundary
+        # (once the collectors have had a moment to write), until SIGTERM
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while not self.stopping.is_set():
+            self.run()
+            self._write_stats()
+            now = time.time()
+            wakeup = now - (now % self.INTERVAL) + self.INTERVAL + self.DAEMON_DELAY
+            self._wait_until(wakeup)
+        self.close()
+
+    def _ready_until(self):
+        # Slots before this time have data to interpolate from in both
+        # sources: a meter reading at or after the slot, and solar data
+        # covering the panels' +/- INTERVAL/2 window
+        meter = self._source_db(self.METER_DB).execute(_LAST_METERED).fetchall()[0][0]
+        solar = self._source_db(self.SOLAR_DB).execute(_LAST_SYSTEM).fetchall()[0][0]
+        if meter is None or solar is None:
+            return 0
+        return int(min(meter + 1, solar - (self.INTERVAL / 2) + 1))
+
+    def _inotify(self, paths, whole=()):
+        # An inotify descriptor watching the directories that hold paths
+        # (so SQLite's -wal and -journal files are seen too), or None
+        # where inotify isn't available. The paths in whole only count as
+        # changed once they've been written and closed (or moved into
+        # place), so they aren't read half-written.
+        ctypes = _lazy_import('ctypes')
+        util = _lazy_import('ctypes.util')
+        try:
+            libc = ctypes.CDLL(
+                util.find_library('c') or 'libc.so.6',
+                use_errno=True,
+            )
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        mask = 0x002 | 0x008 | 0x080 | 0x100
+        # IN_CLOSE_WRITE | IN_MOVED_TO
+        finished = 0x008 | 0x080
+        self.watch_names = {}
+        for path in list(paths) + list(whole):
+            directory = os.path.dirname(os.path.abspath(path))
+            if libc.inotify_add_watch(fd, directory, mask) < 0:
+                os.close(fd)
+                return None
+            name = os.path.basename(path)
+            if path in whole:
+                self.watch_names[name] = (path, finished)
+                continue
+            for suffix in ('', '-wal', '-journal'):
+                self.watch_names[name + suffix] = (path, mask)
+        return fd
+
+    def _inotify_changes(self, fd):
+        # The watched paths named in pending inotify events
+        changed = set()
+        events = os.read(fd, 65536)
+        offset = 0
+        while offset + 16 <= len(events):
+            (wd, mask, cookie, length) = struct.unpack_from('iIII', events, offset)
+            name = events[offset + 16:offset + 16 + length].rstrip('\0')
+            if name in self.watch_names:
+                (path, wanted) = self.watch_names[name]
+                if mask & wanted:
+                    changed.add(path)
+            offset += 16 + length
+        return changed
+
+    def watch(self):
+        # Like daemon(), but woken by changes to the source databases (and
+        # weather.json): slots are computed as soon as both sources have
+        # data past them, rather than an INTERVAL later. A pass still runs
+        # after every INTERVAL boundary to retry uploads.
+        fd = self._inotify([self.METER_DB, self.SOLAR_DB], [self.WEATHER_JSON])
+        if fd is None:
+            print "inotify isn't available; running as --daemon instead"
+            return self.daemon()
+        self.wake_fds = os.pipe()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        ready = None
+        next_pass = 0
+        force = False
+        while not self.stopping.is_set():
+            t_end = min(self._ready_until(), int(time.time()))
+            now = time.time()
+            if ((force) or
+                (now >= next_pass) or
+                (ready is None) or
+                (t_end > ready and list(self._slots(ready, t_end)) != [])):
+                self.run(t_end)
+                self._write_stats()
+                ready = t_end
+                next_pass = now - (now % self.INTERVAL) + self.INTERVAL + self.DAEMON_DELAY
+                force = False
+
+            try:
+                (readable, writable, errors) = select.select(
+                    [fd, self.wake_fds[0]], [], [],
+                    max(next_pass - time.time(), 0),
+                )
+            except select.error:
+                # Interrupted by a signal (Python 2)
+                continue
+            if fd in readable:
+                if self.WEATHER_JSON in self._inotify_changes(fd):
+                    force = True
+
+        os.close(fd)
+        for wake_fd in self.wake_fds:
+            os.close(wake_fd)
+        self.wake_fds = None
+        self.close()
+
+    def export_rows(self, after=None, until=None):
+        # Yield the computed rows (timestamp, v1 ... v12) after timestamp
+        # after (a resume cursor: the last timestamp already had) and
+        # before until, in timestamp order. They're read EXPORT_BATCH at a
+        # time, each batch carrying on from the last row of the one before,
+        # so memory use doesn't grow with the range, and rows committed in
+        # the meantime (by a poster in another process) are picked up.
+        if after is None:
+            after = -1
+        if until is None:
+            until = sys.maxint
+        while True:
+            self.cursor.execute(_EXPORT_BATCH, (after, until, self.EXPORT_BATCH))
+            rows = self.cursor.fetchall()
+            for row in rows:
+                yield tuple(row)
+            if len(rows) < self.EXPORT_BATCH:
+                return
+            after = rows[-1][0]
+
+    def _export_writer(self, format, out, header):
+        # A function writing a row from export_rows to out
+        columns = ['timestamp'] + ['v%d' % i for i in xrange(1, 13)]
+        if format == 'csv':
+            writer = _lazy_import('csv').writer(out)
+            if header:
+                writer.writerow(columns)
+            return writer.writerow
+        json = _lazy_import('json')
+        def write(row):
+            out.write(json.dumps(collections.OrderedDict(zip(columns, row))) + "\n")
+        return write
+
+    def export(self, after=None, until=None, format='ndjson', output=None, follow=False):
+        # Write rows from export_rows as newline-delimited JSON or CSV, to
+        # stdout or appended to the file output. With follow, carry on
+        # with new slots as they're committed (woken by inotify on
+        # pvoutput.sqlite and its WAL, or checking every DAEMON_DELAY
+        # seconds without it) until the end of the range or SIGTERM.
+        # Nothing else is written to stdout.
+        if output is None:
+            out = sys.stdout
+            header = True
+        else:
+            header = not os.path.exists(output) or os.path.getsize(output) == 0
+            out = open(output, 'a')
+        write = self._export_writer(format, out, header)
+
+        fd = None
+        if follow:
+            self.wake_fds = os.pipe()
+            def stop(signum, frame):
+                self.stopping.set()
+                os.write(self.wake_fds[1], 'x')
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            fd = self._inotify([self.PVO_DB])
+            if fd is None:
+                sys.stderr.write("inotify isn't available; checking every %ds instead\n" % (
+                    self.DAEMON_DELAY))
+
+        last = after
+        try:
+            while not self.stopping.is_set():
+                for row in self.export_rows(last, until):
+                    write(row)
+                    last = row[0]
+                out.flush()
+                if not follow:
+                    break
+                if until is not None:
+                    start = -1 if last is None else last
+                    if next(self._slots(start + 1, until), None) is None:
+                        break
+                changed = False
+                while not changed and not self.stopping.is_set():
+                    if fd is None:
+                        self.stopping.wait(self.DAEMON_DELAY)
+                        changed = True
+                        continue
+                    try:
+                        (readable, writable, errors) = select.select(
+                            [fd, self.wake_fds[0]], [], [],
+                        )
+                    except select.error:
+                        # Interrupted by a signal (Python 2)
+                        continue
+                    if fd in readable:
+                        changed = self.PVO_DB in self._inotify_changes(fd)
+        except IOError as e:
+            # The reader has gone away (e.g. piped to head)
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if self.wake_fds is not None:
+                for wake_fd in self.wake_fds:
+                    os.close(wake_fd)
+                self.wake_fds = None
+            if output is not None:
+                out.close()
+        self.close()
+
+    def _explain(self, db, name, query, params):
+        print "%s: %s" % (name, " ".join(query.split()))
+        for row in db.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall():
+            print "    %s" % row[-1]
+
+    def _index_source_dbs(self):
+        # Index the collectors' databases for the queries we make of them
+        # (they are otherwise only ever opened read-only), and refresh the
+        # query planner's statistics
+        indexes = [
+            (self.METER_DB, [
+                ('metered_ts', '''metered (timestamp, Wh_in, Wh_out)'''),
+                ('demand_ts', '''demand (timestamp, watts)'''),
+            ]),
+            (self.SOLAR_DB, [
+                ('system_ts', '''system (timestamp, etot_Wh)'''),
+                ('panels_ts', '''panels (timestamp, macrf, Tdsp_degC, Tmos_degC, Vin_V)'''),
+            ]),
+        ]
+        for (path, wanted) in indexes:
+            db = self._connect(path, timeout=60)
+            for (name, columns) in wanted:
+                exists = db.execute('''
+                    SELECT name FROM sqlite_master
+                        WHERE type = 'index' AND name = ?
+                    ''', (name,)).fetchall()
+                if exists == []:
+                    print "%s: creating index %s on %s" % (path, name, columns)
+                    db.execute('''CREATE INDEX %s ON %s''' % (name, columns))
+            db.execute('''ANALYZE''')
+            db.commit()
+            db.close()
+
+    def migrate(self):
+        # pvoutput.sqlite is migrated on every start; this also indexes
+        # the collectors' databases, refreshes the statistics for all of
+        # them, and shows how each query is planned
+        self._index_source_dbs()
+        self.cursor.execute('''ANALYZE''')
+        self.pvo_db.commit()
+
+        meter = self._source_db(self.METER_DB)
+        solar = self._source_db(self.SOLAR_DB)
+        dbs = {'metered': meter, 'demand': meter, 'system': solar, 'panels': solar}
+        for (query, table) in _queries.items():
+            # Plans don't depend on the values bound
+            self._explain(dbs.get(table, self.pvo_db), table, query, (0,) * query.count('?'))
+
+        self.close()
+
+    def main(self):
+        self.run()
+        self.close()
+
+
+class _ThreadOutput(object):
+    # Stands in for sys.stdout while PVOutputSystems' threads share it:
+    # each thread's output is kept until it has a whole line, which is
+    # written in one go, after the thread's name (the system it's working
+    # for), so lines from different systems can't run into each other or
+    # be mistaken for one another
+
+    def __init__(self, out):
+        self.out = out
+        self.softspace = 0
+        self.lock = threading.Lock()
+        self.partial = threading.local()
+        # The thread it's made in (the main one) prints as it always has
+        self.main = threading.current_thread()
+
+    def write(self, text):
+        lines = (getattr(self.partial, 'line', '') + text).split("\n")
+        self.partial.line = lines.pop()
+        if lines == []:
+            return
+        thread = threading.current_thread()
+        if thread is not self.main:
+            lines = ["%s: %s" % (thread.name, line) for line in lines]
+        with self.lock:
+            self.out.write("\n".join(lines) + "\n")
+
+    def flush(self):
+        self.out.flush()
+
+
+class PVOutputSystems():
+    # Several systems (see _load_config) served from one process. Each is
+    # a PVOutputPoster, with its own databases, location, tariff and
+    # credentials, and its own upload thread, so each keeps to its own
+    # rate limit. Passes are run by a pool of WORKERS threads, each
+    # looking after its share of the systems (SQLite connections can only
+    # be used by the thread that opened them). The threads only overlap
+    # their waiting (on PVOutput, the databases, the disk): the GIL keeps
+    # the computing itself to one slot at a time across the process. Each
+    # line they print starts with the name of the system it's about (see
+    # _ThreadOutput). The process's time zone (TZ) is the one all of them
+    # post in (_load_config makes sure their locations are in it).
+
+    def __init__(self, config, stats=None, names=None):
+        self.STATS = stats
+        self.systems = config['systems']
+        if names is not None:
+            self.systems = [system for system in self.systems if system['name'] in names]
+        self.WORKERS = max(min(config.get('workers', 4), len(self.systems)), 1)
+
+        self.stopping = threading.Event()
+        self.exit_code = 0
+
+    def _stop(self, signum, frame):
+        print "Caught signal %d; stopping after this pass" % signum
+        self.stopping.set()
+
+    def _serve(self, systems, daemon):
+        # A worker: a pass for each of its systems in turn and, as a
+        # daemon, again shortly after each INTERVAL boundary
+        posters = []
+        try:
+            for system in systems:
+                threading.current_thread().name = system['name']
+                poster = PVOutputPoster(self.STATS, system)
+                poster.stopping = self.stopping
+                posters.append(poster)
+            while posters != [] and not self.stopping.is_set():
+                for poster in list(posters):
+                    if self.stopping.is_set():
+                        break
+                    threading.current_thread().name = poster.NAME
+                    try:
+                        poster.run()
+                    except SystemExit as e:
+                        # Data it can't make sense of; the others carry on
+                        print "stopped (exit code %s)" % e.code
+                        poster.close()
+                        posters.remove(poster)
+                        self.exit_code = e.code
+                        continue
+                    except Exception:
+                        # Likewise, but left as a crash would leave it
+                        # (nothing more is committed)
+                        print "stopped"
+                        _lazy_import('traceback').print_exc()
+                        posters.remove(poster)
+                        self.exit_code = 1
+                        continue
+                    poster._write_stats()
+                if not daemon or posters == []:
+                    break
+                now = time.time()
+                interval = posters[0].INTERVAL
+                posters[0]._wait_until(
+                    now - (now % interval) + interval + posters[0].DAEMON_DELAY)
+        except:
+            self.exit_code = 1
+            raise
+        finally:
+            for poster in posters:
+                poster.close()
+
+    def _run(self, daemon):
+        # One pass over every system or, as a daemon, until SIGTERM; exits
+        # as the poster would if any system stopped on bad data
+        if daemon:
+            signal.signal(signal.SIGTERM, self._stop)
+            signal.signal(signal.SIGINT, self._stop)
+        stdout = sys.stdout
+        sys.stdout = _ThreadOutput(stdout)
+        try:
+            workers = []
+            for i in xrange(self.WORKERS):
+                worker = threading.Thread(
+                    target=self._serve,
+                    args=(self.systems[i::self.WORKERS], daemon),
+                )
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                # With a timeout, so signals are still handled (Python 2)
+                while worker.is_alive():
+                    worker.join(1)
+        finally:
+            sys.stdout = stdout
+        if self.exit_code != 0:
+            sys.exit(self.exit_code)
+
+    def main(self):
+        self._run(False)
+
+    def daemon(self):
+        self._run(True)
+
+    def watch(self):
+        print "--watch isn't supported with --config; running as --daemon instead"
+        self.daemon()
+
+    def recompute(self, first_day, last_day=None, refresh=False):
+        # Each system in turn (each recompute has a process pool already)
+        for system in self.systems:
+            print "%s:" % system['name']
+            PVOutputPoster(self.STATS, system).recompute(first_day, last_day, refresh)
+
+    def migrate(self):
+        for system in self.systems:
+            print "%s:" % system['name']
+            PVOutputPoster(self.STATS, system).migrate()
+
+    def export(self, *args):
+        # Just the one system (see __main__)
+        PVOutputPoster(self.STATS, self.systems[0]).export(*args)
+
 
 if __name__ == "__main__":
-    pvo = PVOutputPoster()
-    pvo.main()
+    parser = argparse.ArgumentParser(
+        description="Post solar & metering data to PVOutput",
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "recompute", "migrate", "export"],
+        help="run (the default): compute and post new slots; "
+             "recompute: rebuild the slots already computed from --from "
+             "to --to; migrate: index the source databases, and show "
+             "how each query is planned; export: write out the slots "
+             "computed (from --from or --after, to --to)",
+    )
+    parser.add_argument(
+        "--from",
+        dest="first_day",
+        type=_date,
+        metavar="YYYY-MM-DD",
+        help="first day to recompute or export",
+    )
+    parser.add_argument(
+        "--to",
+        dest="last_day",
+        type=_date,
+        metavar="YYYY-MM-DD",
+        help="last day to recompute or export (by default, up to the "
+             "last slot computed)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="recompute from the source databases, not what was saved "
+             "of them (after changing or removing source rows)",
+    )
+    parser.add_argument(
+        "--after",
+        type=int,
+        metavar="TIMESTAMP",
+        help="export only the slots after this one (the last one already "
+             "exported, to carry on from there)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["ndjson", "csv"],
+        default="ndjson",
+        help="export as a JSON object per line (the default), or CSV",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        help="export to (the end of) FILE, rather than stdout",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="export new slots as they're computed, until stopped (or "
+             "past --to)",
+    )
+    parser.add_argument(
+        "--config",
+        metavar="FILE",
+        help="serve the systems listed in this JSON file (see "
+             "_load_config), rather than the one set up by the environment",
+    )
+    parser.add_argument(
+        "--system",
+        dest="systems",
+        action="append",
+        metavar="NAME",
+        help="only this system from --config (can be given more than once)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="stay running, and post shortly after every interval",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="stay running, and post as soon as new source data arrives",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report how long imports took (those left until they're "
+             "needed included), and the whole run",
+    )
+    parser.add_argument(
+        "--stats",
+        choices=["json", "prometheus"],
+        help="time each phase, count queries and PVOutput request "
+             "latencies, and write them out after each pass: to "
+             "pvoutput-stats.jsonl (json), or pvoutput.prom (prometheus) "
+             "in the data directory",
+    )
+    args = parser.parse_args()
+
+    if args.command == "recompute" and args.first_day is None:
+        parser.error("recompute needs --from")
+
+    if args.config is not None:
+        try:
+            config = _load_config(args.config)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        pvo = PVOutputSystems(config, args.stats, args.systems)
+        if pvo.systems == []:
+            parser.error("no such system in %s" % args.config)
+        if args.command == "export" and len(pvo.systems) != 1:
+            parser.error("export needs --system to pick one system")
+    elif args.systems is not None:
+        parser.error("--system needs --config")
+    else:
+        pvo = PVOutputPoster(stats=args.stats)
+    if args.command == "recompute":
+        pvo.recompute(args.first_day, args.last_day, args.refresh)
+    elif args.command == "migrate":
+        pvo.migrate()
+    elif args.command == "export":
+        after = args.after
+        if after is None and args.first_day is not None:
+            after = int(time.mktime(args.first_day.timetuple())) - 1
+        until = None
+        if args.last_day is not None:
+            until = int(time.mktime((args.last_day + datetime.timedelta(1)).timetuple()))
+        pvo.export(after, until, args.format, args.output, args.follow)
+    elif args.watch:
+        pvo.watch()
+    elif args.daemon:
+        pvo.daemon()
+    else:
+        pvo.main()
+
+    if args.profile_startup:
+        _profile_startup()
@@ -0,0 +1,644 @@
+import argparse
+import BaseHTTPServer
+import calendar
+import datetime
+import imp
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+pvoutput_poster = imp.load_source(
+    'pvoutput_poster',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pvoutput-poster.py'),
+)
+pvoutput_bench = imp.load_source(
+    'pvoutput_bench',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pvoutput-bench.py'),
+)
+
+
+class PosterTestCase(unittest.TestCase):
+    # A poster with its own (empty) data directory; __init__ opens
+    # pvoutput.sqlite there
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['DATA_DIR'] = self.data_dir
+        os.environ['API_KEY'] = 'test-key'
+        os.environ['SYSTEM_ID'] = '1'
+        self.poster = pvoutput_poster.PVOutputPoster()
+
+    def tearDown(self):
+        self.poster.close()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.data_dir)
+
+
+class SlotsTest(PosterTestCase):
+    # _slots against the per-second scan main() used to do
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        # Slots are UTC; a local time zone with daylight saving mustn't
+        # move them
+        os.environ['TZ'] = 'Australia/Melbourne'
+        time.tzset()
+
+    def tearDown(self):
+        PosterTestCase.tearDown(self)
+        time.tzset()
+
+    def scan(self, t_start, t_end):
+        slots = []
+        for t in range(t_start, t_end):
+            if (((int(time.strftime("%M", time.gmtime(t))) % self.poster.MODULO) != 0) or
+                ((int(time.strftime("%S", time.gmtime(t))) != 0))):
+                continue
+            slots.append(t)
+        return slots
+
+    def check(self, t_start, t_end):
+        self.assertEqual(
+            list(self.poster._slots(t_start, t_end)),
+            self.scan(t_start, t_end),
+        )
+
+    def set_interval(self, interval):
+        self.poster.INTERVAL = interval
+        self.poster.MODULO = interval / 60
+
+    def test_daylight_saving(self):
+        # Melbourne's clocks going forward and back
+        for day in ((2014, 10, 4), (2015, 4, 4)):
+            t = calendar.timegm(day + (16, 0, 0))
+            self.check(t - 4 * 3600 + 17, t + 4 * 3600 - 17)
+
+    def test_boundaries(self):
+        t = calendar.timegm((2014, 11, 19, 12, 0, 0))
+        for t_start in (t - 601, t - 600, t - 599, t - 1, t, t + 1, t + 59, t + 60):
+            for t_end in (t - 1, t, t + 1, t + 600, t + 601, t + 3600, t + 3601):
+                self.check(t_start, t_end)
+
+    def test_intervals(self):
+        # Including MODULOs that don't divide an hour evenly
+        t_start = calendar.timegm((2015, 4, 4, 13, 2, 41))
+        t_end = t_start + 6 * 3600 + 123
+        for interval in (60, 120, 300, 420, 600, 900, 1800, 2700, 3600):
+            self.set_interval(interval)
+            self.check(t_start, t_end)
+
+
+class CostsTest(PosterTestCase):
+    # _costs against _cost, slot by slot, in time zones with daylight
+    # saving and offsets that aren't whole hours
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        self.poster.TARIFF = {
+            'rates': [
+                {'rate': 0.45, 'months': [1, 2, 12], 'days': [1, 2, 3, 4, 5], 'hours': [(15, 21)]},
+                {'rate': 0.22, 'hours': [(7, 15), (21, 23)]},
+            ],
+            'peak': 0.3080,
+            'offpeak': 0.13915,
+            'peak_days': [1, 2, 3, 4, 5],
+            'peak_times': [(7, 23)],
+            'export': [
+                {'rate': 0.12, 'hours': [(16, 19)]},
+                {'rate': 0.05},
+            ],
+        }
+
+    def tearDown(self):
+        PosterTestCase.tearDown(self)
+        time.tzset()
+
+    def check(self, zone, timestamps):
+        os.environ['TZ'] = zone
+        time.tzset()
+        nets = [((t / 7) % 4001) - 2000 for t in timestamps]
+        self.assertEqual(
+            self.poster._costs(nets, timestamps),
+            [self.poster._cost(net, t) for (net, t) in zip(nets, timestamps)],
+        )
+
+    def test_zones(self):
+        # A year of slots, and a year of odd seconds out of order
+        t_start = calendar.timegm((2015, 1, 1, 0, 0, 0))
+        slots = range(t_start, t_start + 366 * 86400, self.poster.INTERVAL)
+        seconds = sorted(range(t_start + 17, t_start + 366 * 86400, 937), key=lambda t: t % 101)
+        for zone in ('UTC', 'Australia/Melbourne', 'Australia/Adelaide', 'Australia/Lord_Howe',
+                     'Asia/Kathmandu', 'America/St_Johns'):
+            self.check(zone, slots)
+            self.check(zone, seconds)
+
+    def test_rows(self):
+        # v9 filled in where there's a net, and left alone where there isn't
+        t = calendar.timegm((2015, 1, 5, 16, 0, 0))
+        rows = [(t + i * 600, 1) + (None,) * 12 for i in xrange(3)]
+        costed = self.poster._cost_rows(rows, [1500, None, -800])
+        self.assertEqual([row[10] for row in costed], [
+            float("%.2f" % (self.poster._cost(1500, t) * 100)),
+            None,
+            float("%.2f" % (self.poster._cost(-800, t + 1200) * 100)),
+        ])
+        self.assertEqual([row[:10] + row[11:] for row in costed], [row[:10] + row[11:] for row in rows])
+
+
+class SlotSeriesTest(PosterTestCase):
+    # Recomputing after source rows have been changed in place, rather
+    # than added, with the source databases indexed (as migrate leaves
+    # them) and not
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        PosterTestCase.tearDown(self)
+
+    def rows(self):
+        db = sqlite3.connect(self.poster.PVO_DB)
+        try:
+            return db.execute('''
+                SELECT * FROM pvoutput
+                    ORDER BY timestamp ASC
+                ''').fetchall()
+        finally:
+            db.close()
+
+    def recompute(self, first_day, refresh):
+        self.poster.close()
+        self.poster = pvoutput_poster.PVOutputPoster()
+        self.poster.recompute(first_day, refresh=refresh)
+        return self.rows()
+
+    def check(self, index):
+        bench = pvoutput_bench.PVOutputBench(argparse.Namespace(
+            span=1, panels=4, seed=1, keep=self.data_dir, no_index=not index,
+            verbose=False, rate_limit=100000, latency=0,
+        ))
+        now = int(time.time())
+        t_end = now - (now % self.poster.INTERVAL) - 3600
+        t_start = t_end - 86400
+        bench._generate(self.poster, t_start, t_end)
+        if index:
+            self.poster._index_source_dbs()
+        self.poster.cursor.execute('''
+            INSERT INTO pvoutput (timestamp, v1, v3, need_upload)
+                VALUES (?, ?, ?, 0)
+            ''', bench.history)
+        self.poster.pvo_db.commit()
+        self.poster._queue_upload = lambda item=None: None
+        self.poster._compute(t_start, t_end)
+        first_day = datetime.date.fromtimestamp(t_start)
+        computed = self.recompute(first_day, False)
+
+        # An hour's meter readings raised (as a fixed-up collector might)
+        t = t_start + 12 * 3600
+        db = sqlite3.connect(self.poster.METER_DB)
+        db.execute('''
+            UPDATE metered SET Wh_in = Wh_in + 5000000
+                WHERE timestamp >= ? AND timestamp < ?
+            ''', (t, t + 3600))
+        db.commit()
+        db.close()
+
+        recomputed = self.recompute(first_day, False)
+        self.assertNotEqual(recomputed, computed)
+        self.assertEqual(recomputed, self.recompute(first_day, True))
+
+    def test_indexed(self):
+        self.check(True)
+
+    def test_unindexed(self):
+        self.check(False)
+
+
+class PanelsTest(PosterTestCase):
+    # The panel medians _prefetch_source_data works out for a whole run of
+    # slots at once against _lookup_solar_data's per-slot query: odd and
+    # even numbers of panels, ties, readings missing a value, and readings
+    # on the boundary between two slots' windows
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        PosterTestCase.tearDown(self)
+
+    def check(self, index):
+        bench = pvoutput_bench.PVOutputBench(argparse.Namespace(
+            span=1, panels=1, seed=1, keep=self.data_dir, no_index=True,
+            verbose=False, rate_limit=100000, latency=0,
+        ))
+        now = int(time.time())
+        t_end = now - (now % self.poster.INTERVAL) - 3600
+        t_start = t_end - 86400
+        bench._generate(self.poster, t_start, t_end)
+        slots = list(self.poster._slots(t_start + 3600, t_start + 9 * 3600))
+
+        rand = random.Random(1)
+        half = self.poster.INTERVAL / 2
+        values = [20, 20.5, 20.5, 21, 21.1, 21.2, 21.3, None]
+        rows = []
+        for (i, t) in enumerate(slots):
+            for panel in xrange(1 + i % 6):
+                macrf = '%06x' % (0x4a3f00 + panel)
+                for offset in (-half, -half, -120, 0, 60, half - 1, half):
+                    rows.append((t + offset, macrf) + tuple(rand.choice(values) for column in xrange(3)))
+        db = sqlite3.connect(self.poster.SOLAR_DB)
+        db.execute('''DELETE FROM panels''')
+        db.executemany('''INSERT INTO panels VALUES (?, ?, ?, ?, ?)''', rows)
+        db.commit()
+        db.close()
+        if index:
+            self.poster._index_source_dbs()
+            # The batch query, which is otherwise left to unindexed panels
+            self.poster._indexed = lambda cursor, table, column: False
+
+        self.poster._prefetch_source_data(slots)
+        batch = dict(self.poster.panel_series)
+        self.assertEqual(sorted(batch), slots)
+        keys = ('Cdsp_avg', 'Cmos_avg', 'Vin_avg')
+        for t in slots:
+            self.poster.panel_series = {}
+            results = self.poster._lookup_solar_data(t)
+            self.assertEqual(batch[t], dict((key, results[key]) for key in keys if key in results))
+        self.assertNotEqual([len(batch[t]) for t in slots], [0] * len(slots))
+
+    def test_unindexed(self):
+        self.check(False)
+
+    def test_indexed(self):
+        self.check(True)
+
+
+class RecordingPVOutput(pvoutput_bench.StubPVOutput):
+    # The bench's stub PVOutput, keeping the statuses of each request it
+    # answers, and hanging up without a reply on the requests (counted
+    # from 0) in server.drop
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        if server.requests.value in server.drop:
+            server.requests.value += 1
+            self.close_connection = 1
+            return
+        server.posts.append((self.path, urlparse.parse_qs(body)))
+        # Let the stub read the body again
+        rfile = self.rfile
+        self.rfile = StringIO.StringIO(body)
+        try:
+            pvoutput_bench.StubPVOutput.do_POST(self)
+        finally:
+            self.rfile = rfile
+
+
+class StubPVOutputTestCase(PosterTestCase):
+    # A poster uploading to a stub PVOutput
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RecordingPVOutput)
+        self.server.ADDSTATUS = self.poster.PVO_ADDSTATUS
+        self.server.ADDBATCHSTATUS = self.poster.PVO_ADDBATCHSTATUS
+        self.server.RATE_LIMIT = 300
+        self.server.BATCH_LIMIT = 100
+        self.server.LATENCY = 0
+        self.server.rate_remaining = self.server.RATE_LIMIT
+        self.server.rate_reset = 0
+        self.server.requests = multiprocessing.Value('i', 0)
+        self.server.posts = []
+        self.server.drop = set()
+        self.serving = threading.Thread(target=self.server.serve_forever)
+        self.serving.daemon = True
+        self.serving.start()
+
+        self.poster.PVO_HOST = '127.0.0.1:%d' % self.server.server_port
+        self.poster.UPLOAD_RETRY = 0.1
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        PosterTestCase.tearDown(self)
+        sys.stdout = self.stdout
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class UploadTest(StubPVOutputTestCase):
+    # The upload worker against a stub PVOutput
+
+    def add_rows(self, count):
+        # count rows to upload, a slot apart, ending with the last slot;
+        # returns PVOutput's (d, t) for each, newest first
+        now = int(time.time())
+        last = now - (now % self.poster.INTERVAL)
+        statuses = []
+        for i in xrange(count):
+            t = last - i * self.poster.INTERVAL
+            self.poster.cursor.execute('''
+                INSERT INTO pvoutput (timestamp, need_upload, v1, v2)
+                    VALUES (?, 1, ?, ?)
+                ''', (t, 1000 + i, 500))
+            statuses.append((
+                time.strftime("%Y%m%d", time.localtime(t)),
+                time.strftime("%H:%M", time.localtime(t)),
+            ))
+        self.poster.pvo_db.commit()
+        return statuses
+
+    def waiting(self):
+        self.poster.cursor.execute('''
+            SELECT COUNT(*) FROM pvoutput
+                WHERE need_upload = 1
+            ''')
+        return self.poster.cursor.fetchall()[0][0]
+
+    def batches(self):
+        # The (d, t) of each status posted, a list per request
+        batches = []
+        for (path, params) in self.server.posts:
+            self.assertEqual(path, self.poster.PVO_ADDBATCHSTATUS)
+            batches.append([
+                tuple(status.split(',')[:2])
+                for status in params['data'][0].split(';')
+            ])
+        return batches
+
+    def upload(self):
+        self.poster._queue_upload()
+        self.poster._finish_uploads()
+
+    def test_batches(self):
+        # Full batches, newest first, then what's left
+        statuses = self.add_rows(65)
+        self.upload()
+        self.assertEqual(self.batches(), [statuses[0:30], statuses[30:60], statuses[60:65]])
+        self.assertEqual(self.waiting(), 0)
+        self.assertEqual(self.poster.rate_limit, 300)
+
+    def test_reconnect(self):
+        # A kept-alive connection PVOutput has hung up on is reopened, and
+        # the request sent again straight away
+        statuses = self.add_rows(65)
+        self.server.drop.add(1)
+        self.upload()
+        self.assertEqual(self.server.requests.value, 4)
+        self.assertEqual(self.batches(), [statuses[0:30], statuses[30:60], statuses[60:65]])
+        self.assertEqual(self.waiting(), 0)
+
+    def test_retry(self):
+        # When PVOutput can't be reached, the worker leaves the rows
+        # waiting and tries again after a backoff
+        statuses = self.add_rows(45)
+        self.server.drop.add(0)
+        self.poster._queue_upload()
+        deadline = time.time() + 10
+        while self.waiting() > 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.poster._finish_uploads()
+        self.assertEqual(self.server.requests.value, 3)
+        self.assertEqual(self.batches(), [statuses[0:30], statuses[30:45]])
+        self.assertEqual(self.waiting(), 0)
+
+    def test_retry_single(self):
+        # Posting a status at a time, the pass stops at the first request
+        # that fails rather than trying each row in turn
+        self.add_rows(5)
+        self.poster.PVO_BATCH_SIZE = 1
+        self.server.drop.add(0)
+        self.poster.ul_db = self.poster._open_pvo_db()
+        self.poster.ul_cursor = self.poster.ul_db.cursor()
+        try:
+            self.assertFalse(self.poster._upload(True))
+            self.assertEqual(self.server.requests.value, 1)
+            self.assertEqual(self.waiting(), 5)
+            self.assertTrue(self.poster._upload(True))
+        finally:
+            self.poster._close_connection()
+            self.poster.ul_cursor.close()
+            self.poster.ul_db.close()
+        self.assertEqual(self.server.requests.value, 6)
+        self.assertEqual([path for (path, params) in self.server.posts], [self.poster.PVO_ADDSTATUS] * 5)
+        self.assertEqual(self.waiting(), 0)
+
+
+class RecordingCursor(sqlite3.Cursor):
+    # Appends each statement run, whitespace-normalised, to the file
+    # RecordingConnection.log (shared with recompute's worker processes)
+
+    def record(self, sql):
+        if RecordingConnection.log is not None:
+            with open(RecordingConnection.log, 'a') as fh:
+                fh.write(" ".join(sql.split()) + "\n")
+
+    def execute(self, sql, *args):
+        self.record(sql)
+        return sqlite3.Cursor.execute(self, sql, *args)
+
+    def executemany(self, sql, *args):
+        self.record(sql)
+        return sqlite3.Cursor.executemany(self, sql, *args)
+
+
+class RecordingConnection(sqlite3.Connection):
+    log = None
+
+    def cursor(self, factory=RecordingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+class QueriesTest(StubPVOutputTestCase):
+    # Every statement a pass runs is one migrate explains
+
+    # Schema changes and planner housekeeping, which aren't
+    SKIP = ('PRAGMA', 'CREATE', 'DROP', 'ANALYZE', 'EXPLAIN')
+
+    def setUp(self):
+        StubPVOutputTestCase.setUp(self)
+        self.connect = sqlite3.connect
+        RecordingConnection.log = os.path.join(self.data_dir, 'statements.log')
+
+    def tearDown(self):
+        sqlite3.connect = self.connect
+        RecordingConnection.log = None
+        StubPVOutputTestCase.tearDown(self)
+
+    def reopen(self):
+        self.poster.close()
+        self.poster = pvoutput_poster.PVOutputPoster()
+        self.poster.PVO_HOST = '127.0.0.1:%d' % self.server.server_port
+        self.poster.UPLOAD_RETRY = 0.1
+
+    def run_pass(self):
+        bench = pvoutput_bench.PVOutputBench(argparse.Namespace(
+            span=1, panels=3, seed=1, keep=self.data_dir, no_index=True,
+            verbose=False, rate_limit=100000, latency=0,
+        ))
+        now = int(time.time())
+        t_end = now - (now % self.poster.INTERVAL) - 3600
+        t_start = t_end - 86400
+        t_mid = t_start + 43200
+        bench._generate(self.poster, t_start, t_end)
+        self.poster.cursor.execute('''
+            INSERT INTO pvoutput (timestamp, v1, v3, need_upload)
+                VALUES (?, ?, ?, 0)
+            ''', bench.history)
+        self.poster.pvo_db.commit()
+        connect = self.connect
+        sqlite3.connect = lambda *args, **kwargs: connect(*args, factory=RecordingConnection, **kwargs)
+        self.reopen()
+
+        # Half a day from the unindexed sources, uploaded as it goes, and
+        # the temperatures for it coming in afterwards
+        self.poster._compute(t_start, t_mid)
+        self.poster._finish_uploads()
+        with open(self.poster.WEATHER_JSON, 'wb') as fh:
+            fh.write(json.dumps({'observations': {'data': [
+                {'aifstime_utc': time.strftime("%Y%m%d%H%M%S", time.gmtime(t)), 'air_temp': 20.5}
+                for t in xrange(t_start, t_end, 1800)
+            ]}}))
+        self.poster._ingest_temperatures()
+
+        # The rest from the indexed sources (as migrate leaves them)
+        log = RecordingConnection.log
+        RecordingConnection.log = None
+        self.poster._index_source_dbs()
+        RecordingConnection.log = log
+        self.poster._compute(t_mid, t_end)
+        self.poster._finish_uploads()
+
+        first_day = datetime.date.fromtimestamp(t_start)
+        for refresh in (False, True):
+            self.reopen()
+            self.poster.recompute(first_day, refresh=refresh)
+        self.reopen()
+        self.assertNotEqual(list(self.poster.export_rows()), [])
+
+        RecordingConnection.log = None
+        with open(log) as fh:
+            return set(line.rstrip("\n") for line in fh)
+
+    def test_explained(self):
+        run = set(
+            statement for statement in self.run_pass()
+            if statement.split()[0] not in self.SKIP
+        )
+        explained = set()
+        self.poster._explain = lambda db, name, query, params: explained.add(" ".join(query.split()))
+        self.poster.migrate()
+        self.assertNotEqual(run, set())
+        self.assertEqual(run - explained, set())
+
+
+class WeatherTest(PosterTestCase):
+    # weather.json caught half-written
+
+    def setUp(self):
+        PosterTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        self.raw = json.dumps({'observations': {'data': [
+            {'aifstime_utc': '20141119120000', 'air_temp': 21.5},
+            {'aifstime_utc': '20141119113000', 'air_temp': 20.9},
+        ]}})
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        PosterTestCase.tearDown(self)
+
+    def write(self, raw):
+        with open(self.poster.WEATHER_JSON, 'wb') as fh:
+            fh.write(raw)
+
+    def test_partial(self):
+        # Not ingested (nor recorded as ingested) until it's all there
+        self.write(self.raw[:len(self.raw) / 2])
+        self.assertEqual(self.poster._get_temperature_data(), {})
+        self.assertEqual(self.poster._get_ingest_state(self.poster.WEATHER_JSON), None)
+        self.write(self.raw)
+        self.assertEqual(self.poster._get_temperature_data(), {
+            '1416398400': 21.5,
+            '1416396600': 20.9,
+        })
+        self.assertNotEqual(self.poster._get_ingest_state(self.poster.WEATHER_JSON), None)
+        self.assertEqual(self.poster._get_temperature_data(), {})
+
+    def test_watch(self):
+        # --watch only looks at it once it's been closed
+        fd = self.poster._inotify([self.poster.METER_DB], [self.poster.WEATHER_JSON])
+        if fd is None:
+            self.skipTest("inotify isn't available")
+        try:
+            with open(self.poster.WEATHER_JSON, 'wb') as fh:
+                fh.write(self.raw[:10])
+                fh.flush()
+                self.assertEqual(self.poster._inotify_changes(fd), set())
+                fh.write(self.raw[10:])
+            self.assertEqual(self.poster._inotify_changes(fd), set([self.poster.WEATHER_JSON]))
+            with open(self.poster.METER_DB + '-wal', 'wb') as fh:
+                fh.write('x')
+                fh.flush()
+                self.assertEqual(self.poster._inotify_changes(fd), set([self.poster.METER_DB]))
+        finally:
+            os.close(fd)
+
+
+
+class ThreadOutputTest(unittest.TestCase):
+    # What PVOutputSystems' threads print: each line after the name of the
+    # thread's system, and never run together with another thread's
+
+    def test_lines(self):
+        out = StringIO.StringIO()
+        stdout = sys.stdout
+        sys.stdout = pvoutput_poster._ThreadOutput(out)
+
+        def serve():
+            for i in xrange(200):
+                sys.stdout.write("%d" % i)
+                time.sleep(0)
+                print "; %s" % threading.current_thread().name
+
+        try:
+            threads = [threading.Thread(target=serve, name=name) for name in ('home', 'shed', 'barn')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            print "done"
+        finally:
+            sys.stdout = stdout
+        lines = out.getvalue().split("\n")
+        self.assertEqual(lines[-2:], ['done', ''])
+        self.assertEqual(len(lines), 602)
+        for name in ('home', 'shed', 'barn'):
+            self.assertEqual(
+                [line for line in lines if line.startswith(name + ': ')],
+                ['%s: %d; %s' % (name, i, name) for i in xrange(200)],
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()